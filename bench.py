@@ -0,0 +1,251 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from tree import Node, Record, SymptomMatrix, build_tree, optimal_tree, parse_data
+
+
+def symptoms_of(records):
+    symptoms = []
+    for record in records:
+        for symptom in record.symptoms:
+            if symptom not in symptoms:
+                symptoms.append(symptom)
+    return symptoms
+
+
+def best_of(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_compiled_diagnose(filepath="big_data.txt", depth=16):
+    records = parse_data(filepath)
+    diagnoser = build_tree(records, symptoms_of(records)[:depth])
+
+    def run(queries):
+        return lambda: [diagnoser.diagnose(symptoms) for symptoms in queries]
+
+    node_time = best_of(run([record.symptoms for record in records]))
+    diagnoser.compile()
+    compiled_time = best_of(run([record.symptoms for record in records]))
+    mask_time = best_of(run([record.mask for record in records]))
+    print(f"diagnose x{len(records)} depth {depth}: node walk {node_time:.4f}s, "
+          f"compiled {compiled_time:.4f}s, compiled on masks {mask_time:.4f}s")
+
+
+def bench_function(filepath="big_data.txt", depth=4):
+    records = parse_data(filepath)
+    diagnoser = optimal_tree(records, symptoms_of(records), depth)
+    masks = [record.mask for record in records]
+    sets = [set(record.symptoms) for record in records]
+    node_time = best_of(lambda: [diagnoser.diagnose(symptoms) for symptoms in sets])
+    diagnose = diagnoser.to_function()
+    mask_time = best_of(lambda: [diagnose(mask) for mask in masks])
+    diagnose = diagnoser.to_function("set")
+    set_time = best_of(lambda: [diagnose(symptoms) for symptoms in sets])
+    print(f"diagnose x{len(records)} optimal depth {depth}: node walk {node_time:.4f}s, "
+          f"generated on masks {mask_time:.4f}s, generated on sets {set_time:.4f}s")
+
+
+def bench_diagnose_many(filepath="big_data.txt", depth=16):
+    records = parse_data(filepath)
+    diagnoser = build_tree(records, symptoms_of(records)[:depth])
+    loop_time = best_of(lambda: [diagnoser.diagnose(record.symptoms) for record in records])
+    encode_time = best_of(lambda: SymptomMatrix(records))
+    matrix = SymptomMatrix(records)
+    batch_time = best_of(lambda: diagnoser.diagnose_many(matrix))
+    rate_time = best_of(lambda: diagnoser.calculate_success_rate(matrix))
+    print(f"diagnose x{len(records)} depth {depth}: loop {loop_time:.4f}s, encode {encode_time:.4f}s, "
+          f"diagnose_many {batch_time:.4f}s, success rate {rate_time:.4f}s")
+
+
+def bench_optimal_tree(filepath="big_data.txt", depths=(2, 3, 4, 5)):
+    records = parse_data(filepath)
+    symptoms = symptoms_of(records)
+    for depth in depths:
+        elapsed = best_of(lambda: optimal_tree(records, symptoms, depth), repeat=3)
+        print(f"optimal_tree depth {depth} over {len(symptoms)} symptoms: {elapsed:.4f}s")
+
+
+class DictNode:
+    def __init__(self, data, yes_child=None, no_child=None):
+        self.data = data
+        self.yes_child = yes_child
+        self.no_child = no_child
+
+
+class DictRecord:
+    def __init__(self, illness, symptoms):
+        self.illness = illness
+        self.symptoms = symptoms
+        self.mask = 7
+        self.count = 1
+
+
+def bytes_per_object(factory, count=100000):
+    tracemalloc.start()
+    objects = [factory() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size / count
+
+
+def bench_memory():
+    symptoms = ["fever", "cough", "headache"]
+    for name, before, after in (
+            ("Node", lambda: DictNode("fever"), lambda: Node("fever")),
+            ("Record", lambda: DictRecord("flu", list(symptoms)), lambda: Record("flu", list(symptoms))),
+            ("Record frozen", lambda: DictRecord("flu", list(symptoms)), lambda: Record("flu", symptoms, frozen=True))):
+        print(f"{name}: {bytes_per_object(before):.0f} bytes before, {bytes_per_object(after):.0f} bytes after")
+
+
+SUITE_DATASETS = ("tiny_data.txt", "small_data.txt", "medium_data.txt", "medium_data1.txt", "medium_data2.txt",
+                  "big_data.txt")
+SUITE_DEPTHS = (2, 4, 6)
+
+
+MIN_SAMPLE_TIME = 0.1
+
+
+def run_sample(func, setup, number):
+    arguments = [setup() for _ in range(number)] if setup else None
+    start = time.perf_counter()
+    if setup:
+        for argument in arguments:
+            func(argument)
+    else:
+        for _ in range(number):
+            func()
+    return time.perf_counter() - start
+
+
+def timed(func, setup=None, repeat=5, warmup=1):
+    # Best seconds per call over repeat samples (the least disturbed run). The call count per sample doubles
+    # until a sample takes MIN_SAMPLE_TIME, so millisecond calls are not timed one at a time; setup output is
+    # passed to func untimed.
+    number = 1
+    while run_sample(func, setup, number) < MIN_SAMPLE_TIME:
+        number *= 2
+    for _ in range(warmup):
+        run_sample(func, setup, number)
+    return min(run_sample(func, setup, number) / number for _ in range(repeat))
+
+
+def calibration_loop():
+    total = 0
+    for i in range(20000):
+        total += i & 7
+    return total
+
+
+CALIBRATION_REPEAT = 20
+
+
+def suite_cases(datasets=SUITE_DATASETS, depths=SUITE_DEPTHS, seed=0):
+    # name -> (func, setup) for every suite timing, so flagged timings can be measured again.
+    cases = {"calibration": (calibration_loop, None)}
+    for filepath in datasets:
+        cases.update(dataset_cases(filepath, depths, random.Random(seed)))
+    return cases
+
+
+def dataset_cases(filepath, depths, rng):
+    records = parse_data(filepath)
+    symptoms = sorted(symptoms_of(records))
+    queries = [rng.choice(records).symptoms for _ in range(1000)]
+    diagnoser = build_tree(records, symptoms)
+    cases = {
+        "parse_data": (lambda: parse_data(filepath), None),
+        "build_tree": (lambda: build_tree(records, symptoms), None),
+    }
+    for depth in depths:
+        if depth <= len(symptoms):
+            cases[f"optimal_tree[{depth}]"] = (lambda depth=depth: optimal_tree(records, symptoms, depth), None)
+    cases["diagnose"] = (lambda: [diagnoser.diagnose(query) for query in queries], None)
+    cases["calculate_success_rate"] = (lambda: diagnoser.calculate_success_rate(records), None)
+    cases["minimize"] = (lambda tree: tree.minimize(True), lambda: build_tree(records, symptoms))
+    return {f"{filepath}:{name}": case for name, case in cases.items()}
+
+
+def time_cases(cases, repeat=5, warmup=1):
+    # "calibration" times a fixed pure-Python loop, so runs on a faster or busier machine can be compared.
+    # It is the best of CALIBRATION_REPEAT samples taken before and after the rest, so one disturbed
+    # sample does not move every threshold.
+    calibrate = cases.get("calibration")
+    results = {}
+    if calibrate:
+        results["calibration"] = timed(*calibrate, max(repeat, CALIBRATION_REPEAT), warmup)
+    for name, (func, setup) in cases.items():
+        if name != "calibration":
+            results[name] = timed(func, setup, repeat, warmup)
+    if calibrate:
+        results["calibration"] = min(results["calibration"], timed(*calibrate, max(repeat, CALIBRATION_REPEAT), warmup))
+    return results
+
+
+def bench_suite(datasets=SUITE_DATASETS, depths=SUITE_DEPTHS, seed=0, repeat=5, warmup=1):
+    return time_cases(suite_cases(datasets, depths, seed), repeat, warmup)
+
+
+def regressions(results, baseline, threshold):
+    # Timings are compared relative to each run's calibration loop, which cancels machine speed drift.
+    scale = results["calibration"] / baseline["calibration"] if "calibration" in baseline else 1.0
+    return {name: (baseline[name], seconds) for name, seconds in results.items()
+            if name != "calibration" and name in baseline and seconds > baseline[name] * scale * (1 + threshold)}
+
+
+def confirmed_regressions(results, baseline, threshold, cases, repeat=5, warmup=1):
+    # A timing over the threshold is measured again and keeps the better of its two runs, so a sample
+    # disturbed by other load on the machine does not fail the gate on its own.
+    slower = regressions(results, baseline, threshold)
+    if slower:
+        retimed = time_cases({name: cases[name] for name in slower}, repeat, warmup)
+        results = {name: min(seconds, retimed.get(name, seconds)) for name, seconds in results.items()}
+        slower = regressions(results, baseline, threshold)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the tree module over the bundled datasets.")
+    parser.add_argument("--suite", action="store_true", help="run the dataset suite instead of the ad-hoc reports")
+    parser.add_argument("--output", help="write suite results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against; create one on the machine that "
+                                           "will run the check with --suite --output bench_baseline.json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown over the baseline")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    if not args.suite:
+        bench_compiled_diagnose()
+        bench_diagnose_many()
+        bench_function()
+        bench_optimal_tree()
+        bench_memory()
+        return 0
+    cases = suite_cases(seed=args.seed)
+    results = time_cases(cases, repeat=args.repeat)
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.6f}s")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = confirmed_regressions(results, json.load(file), args.threshold, cases, args.repeat)
+        for name, (before, after) in slower.items():
+            print(f"REGRESSION {name}: {before:.6f}s -> {after:.6f}s")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+from tree import Diagnoser, parse_data
+
+LATENCY_WINDOW = 10000
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class DiagnosisServer:
+    # Serves Diagnoser.diagnose over JSON lines: {"request_id": ..., "symptoms": [...]} in,
+    # {"request_id": ..., "illness": ...} out. Requests from every connection share one queue;
+    # a single batcher drains it into micro-batches of at most max_batch, waiting no longer than
+    # max_delay after the first request, and answers each batch with one diagnose_many call.
+    # The queue is bounded, so a full queue stops reading from clients (backpressure). The diagnoser is
+    # compiled once here, which also registers its symptoms before the first request is encoded.
+    def __init__(self, diagnoser, max_batch=256, max_delay=0.002, queue_size=4096):
+        self.diagnoser = diagnoser.compile()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(queue_size)
+        # Only the most recent latencies are kept, so stats() stays cheap on a long-running server.
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batches = 0
+        self.served = 0
+        self.started = time.perf_counter()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        return {"served": self.served, "batches": self.batches,
+                "p50": percentile(self.latencies, 0.5), "p99": percentile(self.latencies, 0.99),
+                "throughput": self.served / elapsed if elapsed else 0.0}
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                illnesses = self.diagnoser.diagnose_many([symptoms for symptoms, _, _ in batch])
+            except Exception as error:
+                # The batch fails, not the batcher: every waiting request gets the error.
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            now = time.perf_counter()
+            for (_, future, received), illness in zip(batch, illnesses):
+                if not future.done():
+                    future.set_result(illness)
+                self.latencies.append(now - received)
+            self.batches += 1
+            self.served += len(batch)
+
+    async def answer(self, request_id, future, writer):
+        try:
+            response = {"request_id": request_id, "illness": await future}
+        except Exception as error:
+            response = {"request_id": request_id, "error": str(error)}
+        writer.write(json.dumps(response).encode() + b"\n")
+
+    async def handle(self, reader, writer):
+        pending = set()
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    writer.write(json.dumps({"error": "Invalid JSON"}).encode() + b"\n")
+                    continue
+                if not isinstance(request, dict):
+                    writer.write(json.dumps({"error": "Request must be a JSON object"}).encode() + b"\n")
+                    continue
+                if request.get("stats"):
+                    writer.write(json.dumps(self.stats()).encode() + b"\n")
+                    continue
+                symptoms = request.get("symptoms", [])
+                if not isinstance(symptoms, list) or not all(isinstance(symptom, str) for symptom in symptoms):
+                    error = {"request_id": request.get("request_id"), "error": "symptoms must be a list of strings"}
+                    writer.write(json.dumps(error).encode() + b"\n")
+                    continue
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put((symptoms, future, time.perf_counter()))
+                task = asyncio.create_task(self.answer(request.get("request_id"), future, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await writer.drain()
+            if pending:
+                await asyncio.gather(*pending)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8765):
+        self.batcher_task = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        return server
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.batcher_task.cancel()
+
+
+async def load_client(requests, host="127.0.0.1", port=8765, connections=8):
+    # Sends the requests over several connections at once and returns the client-side
+    # p50/p99 latency and throughput.
+    latencies = []
+
+    async def run(chunk):
+        reader, writer = await asyncio.open_connection(host, port)
+        sent = {}
+        for i, symptoms in chunk:
+            sent[i] = time.perf_counter()
+            writer.write(json.dumps({"request_id": i, "symptoms": symptoms}).encode() + b"\n")
+        await writer.drain()
+        for _ in chunk:
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent[response["request_id"]])
+        writer.close()
+        await writer.wait_closed()
+
+    requests = list(enumerate(requests))
+    start = time.perf_counter()
+    await asyncio.gather(*(run(requests[k::connections]) for k in range(connections)))
+    elapsed = time.perf_counter() - start
+    return {"requests": len(requests), "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+            "throughput": len(requests) / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a saved Diagnoser over JSON lines.")
+    parser.add_argument("command", choices=["serve", "load"])
+    parser.add_argument("path", help="saved Diagnoser (serve) or records file (load)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-delay", type=float, default=0.002)
+    parser.add_argument("--connections", type=int, default=8)
+    args = parser.parse_args()
+    if args.command == "serve":
+        server = DiagnosisServer(Diagnoser.load(args.path), args.max_batch, args.max_delay)
+        asyncio.run(server.serve(args.host, args.port))
+    else:
+        requests = [record.symptoms for record in parse_data(args.path)]
+        print(json.dumps(asyncio.run(load_client(requests, args.host, args.port, args.connections))))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
+import asyncio
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
 import unittest
-from tree import Record, Node, Diagnoser, build_tree, optimal_tree, parse_data
+from tree import Record, Node, Diagnoser, HeapDiagnoser, build_tree, optimal_tree, parse_data, vocabulary, SymptomMatrix, iter_records, load_data, instrument
+from server import DiagnosisServer, load_client
+from bench import regressions, confirmed_regressions
 
 class TestDiagnoser(unittest.TestCase):
     def setUp(self):
@@ -47,6 +56,491 @@ class TestDiagnoser(unittest.TestCase):
         optimal = optimal_tree(self.records, self.symptoms, 2)
         self.assertIsInstance(optimal, Diagnoser)
 
+    def test_record_mask(self):
+        for record in parse_data("small_data.txt"):
+            self.assertEqual(set(vocabulary.decode(record.mask)), set(record.symptoms))
+
+    def test_compile(self):
+        records = parse_data("medium_data.txt")
+        diagnoser = build_tree(records, ["fever", "cough", "headache", "fatigue"])
+        expected = [diagnoser.diagnose(record.symptoms) for record in records]
+        diagnoser.compile()
+        self.assertEqual([diagnoser.diagnose(record.symptoms) for record in records], expected)
+        self.assertEqual([diagnoser.diagnose(record.mask) for record in records], expected)
+        self.assertIn("diagnose", vars(diagnoser))
+        diagnoser.minimize(True)
+        self.assertIsNone(diagnoser.compiled)
+        self.assertNotIn("diagnose", vars(diagnoser))
+        diagnoser.compile()
+        self.assertEqual([diagnoser.diagnose(record.symptoms) for record in records], expected)
+        diagnoser.cache()
+        self.assertEqual([diagnoser.diagnose(record.symptoms) for record in records], expected)
+        self.assertEqual(diagnoser.cache_info()["hits"] + diagnoser.cache_info()["misses"], len(records))
+        node = Node("flu")
+        for _ in range(200):
+            node = Node("fever", node, Node(None))
+        deep = Diagnoser(node).compile()
+        self.assertNotIn("diagnose", vars(deep))
+        self.assertEqual(deep.diagnose(["fever"]), "flu")
+
+    def test_diagnose_many(self):
+        records = parse_data("big_data.txt")
+        diagnoser = build_tree(records, ["fever", "cough", "headache", "fatigue", "nausea"])
+        expected = [diagnoser.diagnose(record.symptoms) for record in records]
+        self.assertEqual(diagnoser.diagnose_many(records), expected)
+        self.assertEqual(diagnoser.diagnose_many([record.symptoms for record in records]), expected)
+        successes = sum(1 for record, illness in zip(records, expected) if record.illness == illness)
+        self.assertEqual(diagnoser.calculate_success_rate(SymptomMatrix(records)), successes / len(records))
+        self.assertEqual(self.diagnoser.diagnose_many([["cough"], ["headache"]]), ["Cold", None])
+        mixed = [records[0].symptoms, records[1], records[2].mask, records[3].symptoms]
+        self.assertEqual(diagnoser.diagnose_many(mixed), expected[:4])
+        self.assertEqual(diagnoser.calculate_success_rate(records), successes / len(records))
+        diagnoser.compile()
+        self.assertEqual(diagnoser.diagnose_many(records), expected)
+        self.assertEqual(diagnoser.diagnose_many(mixed), expected[:4])
+        self.assertEqual(diagnoser.calculate_success_rate(records), successes / len(records))
+        with self.assertRaises(TypeError):
+            diagnoser.diagnose_many([["cough"], None])
+        heap = build_tree(records, ["fever", "cough", "headache", "fatigue", "nausea"], heap=True)
+        self.assertEqual(heap.diagnose_many(records), expected)
+        with self.assertRaises(TypeError):
+            diagnoser.calculate_success_rate(SymptomMatrix([record.symptoms for record in records]))
+
+    def test_optimal_tree_matches_exhaustive_search(self):
+        records = parse_data("medium_data.txt")
+        symptoms = ["fever", "cough", "headache", "fatigue", "nausea", "sore_throat"]
+        for depth in range(1, 5):
+            best_subset, best_accuracy = None, 0
+            for subset in itertools.combinations(symptoms, depth):
+                accuracy = build_tree(records, list(subset)).calculate_success_rate(records)
+                if accuracy > best_accuracy:
+                    best_subset, best_accuracy = subset, accuracy
+            optimal = optimal_tree(records, symptoms, depth)
+            self.assertEqual(optimal.root.data, best_subset[0])
+            self.assertEqual(optimal.calculate_success_rate(records), best_accuracy)
+
+    def test_optimal_tree_workers(self):
+        records = parse_data("medium_data.txt")
+        symptoms = ["fever", "cough", "headache", "fatigue", "nausea", "sore_throat"]
+        serial = optimal_tree(records, symptoms, 3)
+        parallel = optimal_tree(records, symptoms, 3, workers=2)
+        self.assertEqual(parallel.paths_to_illness("influenza"), serial.paths_to_illness("influenza"))
+        self.assertEqual(parallel.root.data, serial.root.data)
+
+    def test_optimal_tree_pruning(self):
+        records = parse_data("big_data.txt")
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        exhaustive = optimal_tree(records, symptoms, 4, workers=2)
+        pruned = optimal_tree(records, symptoms, 4)
+        self.assertEqual(pruned.paths_to_illness("influenza"), exhaustive.paths_to_illness("influenza"))
+        self.assertEqual(pruned.calculate_success_rate(records), exhaustive.calculate_success_rate(records))
+        self.assertGreater(pruned.search_stats["skipped"], 0)
+        stats = optimal_tree(parse_data("tiny_data.txt"), symptoms, 4).search_stats
+        self.assertGreater(stats["skipped"], 0)
+
+    def test_symptom_matrix_index(self):
+        records = parse_data("medium_data2.txt")
+        matrix = SymptomMatrix(records)
+        symptoms = ["fever", "cough", "headache", "fatigue", "sore_throat"]
+        from_records = build_tree(records, symptoms)
+        from_index = build_tree(matrix, symptoms)
+        for illness in from_records.all_illnesses():
+            self.assertEqual(from_index.paths_to_illness(illness), from_records.paths_to_illness(illness))
+        self.assertEqual(from_index.calculate_success_rate(matrix), from_records.calculate_success_rate(records))
+        self.assertEqual(optimal_tree(matrix, symptoms, 3).calculate_success_rate(records),
+                         optimal_tree(records, symptoms, 3).calculate_success_rate(records))
+
+    def test_deduplicated_records(self):
+        records = parse_data("big_data.txt")
+        weighted = parse_data("big_data.txt", deduplicate=True)
+        self.assertLess(len(weighted), len(records))
+        self.assertEqual(sum(record.count for record in weighted), len(records))
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        full = build_tree(records, symptoms)
+        for illness in full.all_illnesses():
+            self.assertEqual(build_tree(weighted, symptoms).paths_to_illness(illness), full.paths_to_illness(illness))
+        self.assertEqual(full.calculate_success_rate(weighted), full.calculate_success_rate(records))
+        self.assertEqual(full.calculate_success_rate(SymptomMatrix(weighted)), full.calculate_success_rate(records))
+        self.assertEqual(optimal_tree(weighted, symptoms, 3).calculate_success_rate(records),
+                         optimal_tree(records, symptoms, 3).calculate_success_rate(records))
+        self.assertEqual(optimal_tree(SymptomMatrix(weighted), symptoms, 3).calculate_success_rate(records),
+                         optimal_tree(records, symptoms, 3).calculate_success_rate(records))
+
+    def test_iter_records(self):
+        records = parse_data("medium_data.txt")
+        streamed = list(iter_records("medium_data.txt", chunk_size=64))
+        self.assertEqual([(r.illness, r.symptoms) for r in streamed], [(r.illness, r.symptoms) for r in records])
+        symptoms = ["fever", "cough", "headache"]
+        diagnoser = build_tree(iter_records("medium_data.txt"), symptoms)
+        self.assertEqual(diagnoser.calculate_success_rate(iter_records("medium_data.txt", chunk_size=100)),
+                         build_tree(records, symptoms).calculate_success_rate(records))
+        self.assertEqual(optimal_tree(iter_records("medium_data.txt"), symptoms, 2).root.data,
+                         optimal_tree(records, symptoms, 2).root.data)
+        with self.assertRaises(ValueError):
+            diagnoser.calculate_success_rate(iter([]))
+
+    def test_load_data_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "small_data.txt")
+            shutil.copy("small_data.txt", filepath)
+            expected = [(record.illness, set(record.symptoms)) for record in parse_data(filepath)]
+            self.assertEqual([(r.illness, set(r.symptoms)) for r in load_data(filepath)], expected)
+            self.assertTrue(os.path.exists(filepath + ".symcache"))
+            self.assertEqual([(r.illness, set(r.symptoms)) for r in load_data(filepath)], expected)
+            with open(filepath + ".symcache", "r+b") as file:
+                file.truncate(os.path.getsize(filepath + ".symcache") - 40)
+            self.assertEqual([(r.illness, set(r.symptoms)) for r in load_data(filepath)], expected)
+            with open(filepath, "a") as file:
+                file.write("flu fever\n")
+            self.assertEqual(load_data(filepath)[-1].illness, "flu")
+            self.assertEqual(sorted(os.listdir(directory)), ["small_data.txt", "small_data.txt.symcache"])
+            self.assertEqual([r.mask for r in load_data(filepath)], [r.mask for r in parse_data(filepath)])
+            wide = os.path.join(directory, "wide.txt")
+            with open(wide, "w") as file:
+                file.write("".join("flu %s w%d\n" % (" ".join("w%d" % j for j in range(i)), 70 + i) for i in range(70)))
+            self.assertEqual([(r.illness, set(r.symptoms), r.mask) for r in load_data(wide)],
+                             [(r.illness, set(r.symptoms), r.mask) for r in parse_data(wide)])
+
+    def test_slots(self):
+        self.assertFalse(hasattr(Node("fever"), "__dict__"))
+        record = Record("Flu", ["fever", "cough", "fever"], frozen=True)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record.symptoms, frozenset(["fever", "cough"]))
+        with self.assertRaises(AttributeError):
+            Record("Flu", ["fever"]).symptoms.append("cough")
+        self.assertEqual(build_tree([record], ["cough"]).diagnose(["cough"]), "Flu")
+
+    def test_heap_layout(self):
+        records = parse_data("test_all_illnesses.txt")
+        symptoms = ["a", "b", "d", "g", "k", "a"]
+        nodes = build_tree(records, symptoms)
+        heap = build_tree(records, symptoms, heap=True)
+        self.assertIsInstance(heap, HeapDiagnoser)
+        self.assertEqual(heap.all_illnesses(), nodes.all_illnesses())
+        self.assertEqual(heap.paths_to_illness("mono"), nodes.paths_to_illness("mono"))
+        self.assertEqual([heap.diagnose(r.symptoms) for r in records], [nodes.diagnose(r.symptoms) for r in records])
+        heap.minimize(True)
+        nodes.minimize(True)
+        self.assertIsNone(heap.leaves)
+        self.assertEqual(heap.paths_to_illness("mono"), nodes.paths_to_illness("mono"))
+
+    def test_shared_build_tree(self):
+        records = parse_data("test_all_illnesses.txt")
+        symptoms = ["a", "b", "d", "g", "k", "a"]
+        shared = build_tree(records, symptoms, shared=True)
+        nodes = build_tree(records, symptoms)
+        self.assertEqual(shared.paths_to_illness("mono"), nodes.paths_to_illness("mono"))
+        distinct, stack = set(), [shared.root]
+        while stack:
+            node = stack.pop()
+            if node is not None and id(node) not in distinct:
+                distinct.add(id(node))
+                stack += [node.yes_child, node.no_child]
+        self.assertLess(len(distinct), 2 ** (len(symptoms) + 1) - 1)
+        wide = build_tree(records, ["x%d" % i for i in range(40)], shared=True)
+        self.assertIsNone(wide.diagnose(["x3"]))
+        big = parse_data("big_data.txt")
+        wide = build_tree(big, ["fever", "cough"] + ["x%d" % i for i in range(40)], shared=True)
+        narrow = build_tree(big, ["fever", "cough"])
+        self.assertEqual(wide.calculate_success_rate(big), narrow.calculate_success_rate(big))
+        self.assertEqual(wide.diagnose_many(big), narrow.diagnose_many(big))
+        self.assertEqual(wide.compile().diagnose(["cough"]), narrow.diagnose(["cough"]))
+        function = wide.to_function()
+        self.assertEqual([function(record.symptoms) for record in big], narrow.diagnose_many(big))
+
+    def test_minimize_deep_tree(self):
+        node = Node("flu")
+        for _ in range(5000):
+            node = Node("fever", Node("cough", node, Node(None)), Node("cough", Node(None), Node(None)))
+        diagnoser = Diagnoser(node)
+        diagnoser.minimize()
+        self.assertEqual(diagnoser.root.data, "fever")
+        diagnoser.minimize(True)
+        self.assertEqual(diagnoser.root.data, "flu")
+
+    def test_lazy_tree(self):
+        records = parse_data("small_data.txt")
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        eager = build_tree(records, symptoms)
+        lazy = build_tree(records, symptoms + ["x%d" % i for i in range(30)], lazy=True, node_budget=50)
+        self.assertEqual([lazy.diagnose(r.symptoms) for r in records], [eager.diagnose(r.symptoms) for r in records])
+        self.assertLessEqual(len(lazy.leaves.cells), 50)
+        self.assertGreater(lazy.leaves.evictions, 0)
+        matrix_lazy = build_tree(SymptomMatrix(records), symptoms + ["x%d" % i for i in range(30)], lazy=True,
+                                 node_budget=5)
+        self.assertEqual([matrix_lazy.diagnose(r.symptoms) for r in records],
+                         [eager.diagnose(r.symptoms) for r in records])
+        self.assertLessEqual(len(matrix_lazy.leaves.cells), 5)
+        self.assertEqual(list(build_tree(SymptomMatrix(records), symptoms[:4], lazy=True).leaves),
+                         build_tree(records, symptoms[:4], heap=True).leaves)
+        small = build_tree(records, symptoms[:4], lazy=True)
+        self.assertEqual(small.all_illnesses(), build_tree(records, symptoms[:4]).all_illnesses())
+
+    def test_illness_index(self):
+        paths = self.diagnoser.iter_paths_to_illness("Flu")
+        self.assertEqual(next(paths), [True, True, False, False])
+        self.assertIsNotNone(self.diagnoser.illness_index)
+        self.diagnoser.minimize(True)
+        self.assertIsNone(self.diagnoser.illness_index)
+        self.assertEqual(self.diagnoser.paths_to_illness("Flu"), [[True, False]])
+        self.assertEqual(self.diagnoser.all_illnesses(), ["Covid", "Flu", "Cold", "Allergy"])
+
+    def test_save_load(self):
+        records = parse_data("big_data.txt")
+        diagnoser = optimal_tree(records, ["fever", "cough", "headache", "fatigue", "nausea"], 3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.bin")
+            diagnoser.save(path)
+            loaded = Diagnoser.load(path)
+            self.assertEqual(loaded.diagnose_many(records), diagnoser.diagnose_many(records))
+            self.assertEqual(loaded.all_illnesses(), diagnoser.all_illnesses())
+            node = Node("flu")
+            for _ in range(5000):
+                node = Node("fever", node, Node(None))
+            Diagnoser(node).save(path)
+            self.assertEqual(Diagnoser.load(path).diagnose(["fever"]), "flu")
+            shared = build_tree(records, ["x%d" % i for i in range(40)], shared=True)
+            shared.save(path)
+            self.assertLess(os.path.getsize(path), 4096)
+            self.assertIsNone(Diagnoser.load(path).diagnose(["x3"]))
+            with open(path, "r+b") as file:
+                file.write(b"NOTMODEL")
+            with self.assertRaises(ValueError):
+                Diagnoser.load(path)
+
+    def test_diagnosis_server(self):
+        records = parse_data("medium_data.txt")
+        diagnoser = build_tree(records, ["fever", "cough", "headache"])
+
+        async def run():
+            server = DiagnosisServer(diagnoser, max_batch=16, queue_size=8)
+            listener = await server.start(port=0)
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                report = await load_client([record.symptoms for record in records], port=port, connections=4)
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b'{"request_id": "a", "symptoms": ["cough"]}\n')
+                answer = json.loads(await reader.readline())
+                writer.write(b'{"request_id": 1, "symptoms": null}\n[1]\n')
+                rejected = [json.loads(await reader.readline()) for _ in range(2)]
+                writer.write(b'{"request_id": "b", "symptoms": ["cough"]}\n')
+                self.assertEqual(json.loads(await reader.readline())["request_id"], "b")
+                writer.write(b'{"stats": true}\n')
+                stats = json.loads(await reader.readline())
+                writer.close()
+                self.assertEqual(rejected[0]["request_id"], 1)
+                self.assertTrue(all("error" in response for response in rejected))
+                self.assertFalse(server.batcher_task.done())
+            server.batcher_task.cancel()
+            return report, answer, stats
+
+        async def failing_batch():
+            server = DiagnosisServer(Diagnoser(None), max_delay=0)
+            listener = await server.start(port=0)
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b'{"request_id": 1, "symptoms": ["cough"]}\n')
+                response = json.loads(await reader.readline())
+                writer.close()
+            alive = not server.batcher_task.done()
+            server.batcher_task.cancel()
+            return response, alive
+
+        async def fresh_model():
+            with tempfile.TemporaryDirectory() as directory:
+                server = DiagnosisServer(self.fresh_model(directory, "served_"), max_delay=0)
+            listener = await server.start(port=0)
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b'{"request_id": 1, "symptoms": ["served_fever", "served_cough"]}\n')
+                response = json.loads(await reader.readline())
+                writer.close()
+            server.batcher_task.cancel()
+            return response, server.diagnoser.compiled
+
+        response, compiled = asyncio.run(fresh_model())
+        self.assertEqual(response, {"request_id": 1, "illness": "strep"})
+        self.assertIsNotNone(compiled)
+        response, alive = asyncio.run(failing_batch())
+        self.assertIn("error", response)
+        self.assertTrue(alive)
+        report, answer, stats = asyncio.run(run())
+        self.assertEqual(report["requests"], len(records))
+        self.assertEqual(answer, {"request_id": "a", "illness": diagnoser.diagnose(["cough"])})
+        self.assertEqual(stats["served"], len(records) + 2)
+        self.assertLess(stats["batches"], stats["served"])
+
+    def test_result_cache(self):
+        records = parse_data("big_data.txt")
+        diagnoser = build_tree(records, ["fever", "cough", "headache"])
+        expected = [diagnoser.diagnose(record.symptoms) for record in records]
+        diagnoser.cache(maxsize=4)
+        self.assertEqual([diagnoser.diagnose(record.symptoms) for record in records], expected)
+        self.assertEqual(diagnoser.diagnose(["fever", "unknown_symptom"]), diagnoser.diagnose(["fever"]))
+        info = diagnoser.cache_info()
+        self.assertEqual(info["misses"] + info["hits"], len(records) + 2)
+        self.assertLessEqual(info["misses"], 8 + info["evictions"])
+        self.assertGreater(info["evictions"], 0)
+        self.assertGreater(info["hit_rate"], 0.9)
+        diagnoser.minimize(True)
+        self.assertEqual(diagnoser.cache_info()["size"], 0)
+        self.assertEqual([diagnoser.diagnose(record.symptoms) for record in records], expected)
+        heap = build_tree(records, ["fever", "cough"], heap=True).cache()
+        self.assertEqual(heap.diagnose(["cough", "nausea"]), heap.diagnose(["cough"]))
+        self.assertEqual(heap.cache_info()["hits"], 1)
+
+    def test_to_function(self):
+        records = parse_data("big_data.txt")
+        diagnoser = optimal_tree(records, ["fever", "cough", "headache", "fatigue", "nausea"], 3)
+        expected = [diagnoser.diagnose(record.symptoms) for record in records]
+        diagnose, diagnose_set = diagnoser.to_function(), diagnoser.to_function("set")
+        self.assertEqual([diagnose(record.symptoms) for record in records], expected)
+        self.assertEqual([diagnose(record.mask) for record in records], expected)
+        self.assertEqual([diagnose_set(set(record.symptoms)) for record in records], expected)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "diagnose.py")
+            diagnoser.to_function(path=path)
+            with open(path) as file:
+                self.assertEqual(file.read(), diagnoser.function_source())
+            diagnose = diagnoser.to_function(path=path)
+            self.assertEqual([diagnose(record.symptoms) for record in records], expected)
+            other = build_tree(records, ["nausea", "fever"])
+            diagnose = other.to_function(mode="set", path=path)
+            self.assertEqual([diagnose(record.symptoms) for record in records], other.diagnose_many(records))
+            with open(path) as file:
+                self.assertEqual(file.read(), other.function_source("set"))
+        self.assertIsNone(Diagnoser(Node(None)).to_function()(["fever"]))
+        node = Node("flu")
+        for _ in range(200):
+            node = Node("fever", node, Node(None))
+        with self.assertRaises(ValueError):
+            Diagnoser(node).function_source()
+
+    def test_instrumentation(self):
+        records = parse_data("medium_data.txt")
+        symptoms = ["fever", "cough", "headache", "fatigue"]
+        with instrument() as stats:
+            diagnoser = optimal_tree(records, symptoms, 2)
+            diagnoser.diagnose(["fever"])
+            diagnoser.minimize()
+        counters = stats.as_dict()["counters"]
+        self.assertEqual(counters["subsets_evaluated"] + counters["subsets_skipped"], 6)
+        self.assertEqual(counters["records_split"], 2 * len(records))
+        self.assertEqual(counters["diagnose_nodes_visited"], 3)
+        self.assertEqual(counters["minimize_subtree_comparisons"], 3)
+        timings = stats.as_dict()["timings"]
+        self.assertGreaterEqual(timings["optimal_tree"], timings["optimal_tree_search"] + timings["build_tree"])
+        self.assertIn("minimize", timings)
+        build_tree(records, symptoms)
+        self.assertEqual(stats.counters["records_split"], 2 * len(records))
+
+    def test_optimal_tree_time_budget(self):
+        records = parse_data("big_data.txt")
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        reports = []
+        anytime = optimal_tree(records, symptoms, 4, time_budget=60, on_progress=reports.append)
+        exhaustive = optimal_tree(records, symptoms, 4)
+        self.assertTrue(anytime.search_stats["complete"])
+        self.assertEqual(anytime.calculate_success_rate(records), exhaustive.calculate_success_rate(records))
+        accuracies = [report["best_accuracy"] for report in reports]
+        self.assertEqual(accuracies, sorted(accuracies))
+        self.assertEqual(accuracies[-1], exhaustive.calculate_success_rate(records))
+        self.assertEqual(reports[-1]["total"], math.comb(len(symptoms), 4))
+        self.assertIsNone(optimal_tree(records, symptoms, 4, time_budget=0))
+        stopped = optimal_tree(SymptomMatrix(records), symptoms, 4, time_budget=60)
+        self.assertTrue(stopped.search_stats["complete"])
+        parallel = optimal_tree(records, symptoms, 2, workers=2, time_budget=60, on_progress=reports.append)
+        self.assertTrue(parallel.search_stats["complete"])
+
+    def test_optimal_tree_time_budget_ties(self):
+        records = [Record("cold", ["b", "c"]), Record("cold", ["d"]), Record("flu", ["b"]), Record("cold", []),
+                   Record("flu", ["a"]), Record("cold", ["b", "c"]), Record("flu", ["b", "d"]), Record("flu", ["a"])]
+        symptoms = ["a", "b", "c", "d"]
+        expected = optimal_tree(records, symptoms, 2)
+        self.assertEqual((expected.root.data, expected.root.yes_child.data), ("a", "b"))
+        for source, workers in ((records, None), (SymptomMatrix(records), None), (records, 2)):
+            budgeted = optimal_tree(source, symptoms, 2, workers=workers, time_budget=100)
+            self.assertTrue(budgeted.search_stats["complete"])
+            self.assertEqual((budgeted.root.data, budgeted.root.yes_child.data), ("a", "b"))
+
+    def test_optimal_tree_checkpoint(self):
+        records = parse_data("big_data.txt")
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        symptoms += ["x%d" % i for i in range(10)]
+
+        def crash(report):
+            if report["evaluated"] > 200:
+                raise KeyboardInterrupt
+
+        for source, workers in ((records, None), (SymptomMatrix(records), None), (records, 2)):
+            expected = optimal_tree(source, symptoms, 4, workers=workers)
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "search.json")
+                with self.assertRaises(KeyboardInterrupt):
+                    optimal_tree(source, symptoms, 4, workers=workers, on_progress=crash,
+                                 checkpoint=path, checkpoint_interval=0)
+                with open(path) as file:
+                    state = json.load(file)
+                self.assertLess(state["index"], state["total"])
+                resumed = optimal_tree(source, symptoms, 4, workers=workers, checkpoint=path)
+                self.assertEqual(resumed.paths_to_illness("influenza"), expected.paths_to_illness("influenza"))
+                self.assertEqual(resumed.calculate_success_rate(records), expected.calculate_success_rate(records))
+                with open(path) as file:
+                    self.assertEqual(json.load(file)["index"], state["total"])
+
+    def test_optimal_tree_checkpoint_after_time_budget(self):
+        records = parse_data("medium_data.txt")
+        symptoms = sorted({symptom for record in records for symptom in record.symptoms})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "search.json")
+            self.assertIsNone(optimal_tree(records, symptoms, 3, time_budget=0, checkpoint=path))
+            resumed = optimal_tree(records, symptoms, 3, checkpoint=path)
+            self.assertTrue(resumed.search_stats["complete"])
+            self.assertEqual(resumed.calculate_success_rate(records),
+                             optimal_tree(records, symptoms, 3).calculate_success_rate(records))
+            with self.assertRaises(ValueError):
+                optimal_tree(records, symptoms, 2, checkpoint=path)
+            other = records[:-1] + [Record("not_" + records[-1].illness, records[-1].symptoms)]
+            with self.assertRaises(ValueError):
+                optimal_tree(other, symptoms, 3, checkpoint=path)
+            self.assertEqual(optimal_tree(SymptomMatrix(records), symptoms, 3, checkpoint=path).calculate_success_rate(
+                records), resumed.calculate_success_rate(records))
+
+    def test_bench_regressions(self):
+        baseline = {"calibration": 1.0, "a": 1.0, "b": 1.0, "gone": 1.0}
+        results = {"calibration": 2.0, "a": 2.4, "b": 2.6, "new": 9.0}
+        self.assertEqual(regressions(results, baseline, 0.25), {"b": (1.0, 2.6)})
+        self.assertEqual(regressions({"calibration": 1.0, "a": 1.3}, {"a": 1.0}, 0.25), {"a": (1.0, 1.3)})
+        self.assertEqual(regressions({"calibration": 1.0, "a": 1.2}, {"a": 1.0}, 0.25), {})
+        cases = {"b": (lambda: None, None)}
+        self.assertEqual(confirmed_regressions(results, baseline, 0.25, cases, repeat=1, warmup=0), {})
+        baseline["b"] = 1e-12
+        self.assertEqual(list(confirmed_regressions(results, baseline, 0.25, cases, repeat=1, warmup=0)), ["b"])
+
+    def fresh_model(self, directory, prefix):
+        # A loaded tree whose symptoms this process has never seen, as in a freshly started server.
+        root = Node(prefix + "fever", Node(prefix + "cough", Node("strep"), Node("flu")), Node("healthy"))
+        path = os.path.join(directory, prefix + "model.bin")
+        Diagnoser(root).save(path)
+        return Diagnoser.load(path)
+
+    def test_fresh_vocabulary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            loaded = self.fresh_model(directory, "many_")
+            queries = [["many_fever", "many_cough"], ["many_fever"], []]
+            self.assertEqual(loaded.diagnose_many(queries), ["strep", "flu", "healthy"])
+            cached = self.fresh_model(directory, "cached_").cache()
+            self.assertEqual(cached.diagnose(["cached_fever", "cached_cough"]), "strep")
+            self.assertEqual(cached.diagnose(["cached_fever", "cached_cough"]), "strep")
+            self.assertEqual(cached.cache_info()["hits"], 1)
+            observed = self.fresh_model(directory, "observed_")
+            with instrument() as stats:
+                self.assertEqual(observed.diagnose(["observed_fever", "observed_cough"]), "strep")
+            self.assertEqual(stats.counters["diagnose_nodes_visited"], 3)
+            self.assertEqual(self.fresh_model(directory, "path_").path_length(["path_fever", "path_cough"]), 3)
+
     # def test_parse_data(self):
     #     # Assuming "test_data.txt" contains valid formatted data
     #     records = parse_data("test_data.txt")
@@ -1,12 +1,112 @@
+import hashlib
 import itertools
-from collections import Counter
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import types
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+class Instrumentation:
+    # Counters and per-phase wall time collected while instrument() is active. Phase times are
+    # inclusive, so optimal_tree also contains the build_tree call that makes its result.
+    def __init__(self):
+        self.counters = Counter()
+        self.timings = Counter()
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def as_dict(self):
+        return {"counters": dict(self.counters), "timings": dict(self.timings)}
+
+
+instrumentation = None
+
+@contextmanager
+def instrument():
+    global instrumentation
+    previous = instrumentation
+    instrumentation = stats = Instrumentation()
+    try:
+        yield stats
+    finally:
+        instrumentation = previous
+
+def phase(name):
+    # Times every call of the decorated function while instrumentation is on; off, it costs one global check.
+    def decorate(func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            stats = instrumentation
+            if stats is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.timings[name] += time.perf_counter() - start
+        return timed
+    return decorate
+
+class Vocabulary:
+    def __init__(self):
+        self.ids = {}
+        self.symptoms = []
+
+    def id(self, symptom):
+        symptom_id = self.ids.get(symptom)
+        if symptom_id is None:
+            symptom_id = len(self.symptoms)
+            self.ids[symptom] = symptom_id
+            self.symptoms.append(symptom)
+        return symptom_id
+
+    def bit(self, symptom):
+        return 1 << self.id(symptom)
+
+    def known_mask(self, symptoms):
+        if isinstance(symptoms, int):
+            return symptoms
+        ids = self.ids
+        mask = 0
+        for symptom in symptoms:
+            if symptom in ids:
+                mask |= 1 << ids[symptom]
+        return mask
+
+    def mask(self, symptoms):
+        mask = 0
+        for symptom in symptoms:
+            mask |= 1 << self.id(symptom)
+        return mask
+
+    def decode(self, mask):
+        return [symptom for i, symptom in enumerate(self.symptoms) if mask >> i & 1]
+
+
+vocabulary = Vocabulary()
 
 class Record:
-    def __init__(self, illness, symptoms):
+    __slots__ = ("illness", "symptoms", "mask", "count")
+
+    def __init__(self, illness, symptoms, count=1, frozen=False, mask=None):
+        # symptoms is stored immutable because mask is computed from it once, here (or passed in by a
+        # caller that already has it).
         self.illness = illness
-        self.symptoms = symptoms
+        self.symptoms = frozenset(symptoms) if frozen else tuple(symptoms)
+        self.mask = vocabulary.mask(symptoms) if mask is None else mask
+        self.count = count
 
 class Node:
+    __slots__ = ("data", "yes_child", "no_child")
+
     def __init__(self, data, yes_child=None, no_child=None):
         self.data = data
         self.yes_child = yes_child
@@ -18,112 +118,775 @@ class Node:
 def is_leaf(node):
     return node is not None and node.yes_child is None and node.no_child is None
 
-def parse_data(filepath):
+def parse_data(filepath, deduplicate=False, frozen=False):
+    records = iter_records(filepath, frozen=frozen)
+    return deduplicate_records(records) if deduplicate else list(records)
+
+def iter_records(filepath, chunk_size=1 << 20, frozen=False):
+    with open(filepath, "rb") as file:
+        tail = b""
+        while chunk := file.read(chunk_size):
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                parts = line.decode().split()
+                if parts:
+                    yield Record(parts[0], parts[1:], frozen=frozen)
+        parts = tail.decode().split()
+        if parts:
+            yield Record(parts[0], parts[1:], frozen=frozen)
+
+CACHE_MAGIC = b"SYMCACHE"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<8sIQQ32sQIII")
+
+def file_digest(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.digest()
+
+def write_cache(filepath, cache_path):
+    # Layout: header, symptom and illness names (newline separated), uint32 illness ids, uint64 mask words.
+    symptoms, illnesses = {}, {}
+    illness_ids, masks = [], []
+    for record in iter_records(filepath):
+        mask = 0
+        for symptom in record.symptoms:
+            mask |= 1 << symptoms.setdefault(symptom, len(symptoms))
+        illness_ids.append(illnesses.setdefault(record.illness, len(illnesses)))
+        masks.append(mask)
+    words = max(1, (len(symptoms) + 63) // 64)
+    names = "\n".join(symptoms).encode() + b"\0" + "\n".join(illnesses).encode()
+    names += b"\0" * (-len(names) % 8)
+    stat = os.stat(filepath)
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, stat.st_mtime_ns, stat.st_size, file_digest(filepath),
+                               len(masks), words, len(names), 0)
+    # Written aside and renamed, so a reader sharing the cache never sees a half-written file.
+    temporary = "%s.%d.tmp" % (cache_path, os.getpid())
+    with open(temporary, "wb") as file:
+        file.write(header)
+        file.write(names)
+        file.write(struct.pack("<%dI" % len(illness_ids), *illness_ids))
+        file.write(b"\0" * (-file.tell() % 8))
+        for mask in masks:
+            file.write(mask.to_bytes(8 * words, "little"))
+    os.replace(temporary, cache_path)
+
+def cache_size(count, words, names_size):
+    ids_size = 4 * count + (-4 * count % 8)
+    return CACHE_HEADER.size + names_size + ids_size + 8 * words * count
+
+def cache_is_fresh(filepath, cache_path):
+    if not os.path.exists(cache_path):
+        return False
+    with open(cache_path, "rb") as file:
+        header = file.read(CACHE_HEADER.size)
+    if len(header) < CACHE_HEADER.size:
+        return False
+    magic, version, mtime, size, digest, count, words, names_size, _ = CACHE_HEADER.unpack(header)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return False
+    if os.path.getsize(cache_path) != cache_size(count, words, names_size):
+        return False
+    stat = os.stat(filepath)
+    if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+        return True
+    if size != stat.st_size or digest != file_digest(filepath):
+        return False
+    # Touched but unchanged: remember the new mtime so the next load skips hashing.
+    with open(cache_path, "r+b") as file:
+        file.seek(12)
+        file.write(struct.pack("<Q", stat.st_mtime_ns))
+    return True
+
+def read_cache(cache_path):
+    with open(cache_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ValueError("Cache file is empty")
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    _, _, _, _, _, count, words, names_size, _ = CACHE_HEADER.unpack_from(view)
+    offset = CACHE_HEADER.size
+    symptom_names, illness_names = bytes(view[offset:offset + names_size]).split(b"\0", 1)
+    illness_names = illness_names.rstrip(b"\0")
+    symptoms = symptom_names.decode().split("\n") if symptom_names else []
+    illnesses = illness_names.decode().split("\n") if illness_names else []
+    offset += names_size
+    illness_ids = view[offset:offset + 4 * count].cast("I")
+    offset += 4 * count + (-4 * count % 8)
+    masks = view[offset:offset + 8 * words * count].cast("Q")
+    return symptoms, illnesses, illness_ids, masks, words
+
+def load_data(filepath, deduplicate=False, cache_path=None):
+    # parse_data through a binary cache next to the source; symptom lists come back in vocabulary order.
+    cache_path = cache_path or filepath + ".symcache"
+    if not cache_is_fresh(filepath, cache_path):
+        write_cache(filepath, cache_path)
+    symptoms, illnesses, illness_ids, masks, words = read_cache(cache_path)
+    # Cache ids are mapped to vocabulary bits once and each distinct stored mask is decoded once, so rows
+    # are built straight from the stored masks without re-encoding their names.
+    bits = [vocabulary.bit(symptom) for symptom in symptoms]
+    decoded = {}
     records = []
-    with open(filepath, "r") as file:
-        for line in file:
-            parts = line.strip().split()
-            if parts:
-                illness, symptoms = parts[0], parts[1:]
-                records.append(Record(illness, symptoms))
-    return records
+    if words == 1:
+        row_masks = masks
+    else:
+        row_masks = (int.from_bytes(masks[row * words:(row + 1) * words].tobytes(), "little")
+                     for row in range(len(illness_ids)))
+    for illness_id, mask in zip(illness_ids, row_masks):
+        entry = decoded.get(mask)
+        if entry is None:
+            ids = [i for i in range(len(symptoms)) if mask >> i & 1]
+            entry = decoded[mask] = (tuple(symptoms[i] for i in ids), sum(bits[i] for i in ids))
+        records.append(Record(illnesses[illness_id], entry[0], mask=entry[1]))
+    return deduplicate_records(records) if deduplicate else records
+
+
+def require_records(records):
+    for record in records:
+        if not isinstance(record, Record):
+            raise TypeError("All elements in records must be of type Record.")
+        yield record
+
+def deduplicate_records(records):
+    # Keeps first-appearance order so majority tie-breaks match the expanded records.
+    unique = {}
+    for record in records:
+        key = (record.illness, record.mask)
+        if key in unique:
+            unique[key].count += record.count
+        else:
+            unique[key] = Record(record.illness, record.symptoms, record.count, mask=record.mask)
+    return list(unique.values())
+
+def iter_chunks(records, size):
+    records = iter(records)
+    while chunk := list(itertools.islice(records, size)):
+        yield chunk
+
+def total_count(records):
+    return sum(record.count for record in records)
+
+BATCH_THRESHOLD = 512
+STREAM_CHUNK_SIZE = 1 << 16
+
+class SymptomMatrix:
+    def __init__(self, records_or_symptom_lists):
+        items = list(records_or_symptom_lists)
+        self.masks = [item.mask if isinstance(item, Record) else vocabulary.known_mask(item) for item in items]
+        self.illnesses = [item.illness for item in items] if all(isinstance(item, Record) for item in items) else None
+        counts = self.counts = [item.count for item in items] if self.illnesses is not None else []
+        self.total = sum(counts) if counts else len(items)
+        self.weight_planes = None
+        if any(count != 1 for count in counts):
+            # Row weights split into binary planes, so a weighted count is still AND plus popcount.
+            self.weight_planes = [int("".join(["1" if count >> plane & 1 else "0" for count in reversed(counts)]), 2)
+                                  for plane in range(max(counts).bit_length())]
+        self.width = max((mask.bit_length() for mask in self.masks), default=0)
+        self.stride = self.width + (self.illnesses is not None)
+        self.all_rows = (1 << len(items)) - 1
+        self.columns = {}
+        self.illness_rows = {}
+        row_format = "0%db" % self.width
+        if self.illnesses is None:
+            self.matrix = "".join([format(mask, row_format) for mask in reversed(self.masks)])
+        else:
+            codes = {}
+            for illness in self.illnesses:
+                codes.setdefault(illness, chr(48 + len(codes)))
+            self.matrix = "".join([format(mask, row_format) + codes[illness]
+                                   for mask, illness in zip(reversed(self.masks), reversed(self.illnesses))])
+            illness_column = self.matrix[self.width::self.stride]
+            for illness, code in codes.items():
+                table = {ord(other): "0" for other in codes.values()}
+                table[ord(code)] = "1"
+                self.illness_rows[illness] = int(illness_column.translate(table), 2)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def column(self, bit):
+        rows = self.columns.get(bit)
+        if rows is None:
+            offset = self.width - bit.bit_length()
+            rows = int(self.matrix[offset::self.stride], 2) if offset >= 0 and self.masks else 0
+            self.columns[bit] = rows
+        return rows
+
+    def count(self, rows):
+        if self.weight_planes is None:
+            return rows.bit_count()
+        return sum((rows & plane).bit_count() << k for k, plane in enumerate(self.weight_planes))
+
+    def majority(self, rows):
+        return max((self.count(rows & illness_rows) for illness_rows in self.illness_rows.values()), default=0)
+
+    def majority_illness(self, rows):
+        # Same tie-break as Counter.most_common: the illness seen first among the rows wins.
+        best_illness, best_count, best_first = None, 0, 0
+        for illness, illness_rows in self.illness_rows.items():
+            matching = rows & illness_rows
+            count = self.count(matching)
+            first = (matching & -matching).bit_length()
+            if count > best_count or (count == best_count and count and first < best_first):
+                best_illness, best_count, best_first = illness, count, first
+        return best_illness
+
+MODEL_MAGIC = b"DIAGNOSR"
+MODEL_VERSION = 1
+MODEL_HEADER = struct.Struct("<8sIIII")
+MAX_FUNCTION_DEPTH = 90
+MAX_COMPILED_NODES = 1 << 14
+CHECKPOINT_VERSION = 2
+
+def batch_masks(records_or_symptom_lists):
+    if isinstance(records_or_symptom_lists, SymptomMatrix):
+        return records_or_symptom_lists.masks
+    return [item.mask if isinstance(item, Record) else vocabulary.known_mask(item) for item in records_or_symptom_lists]
+
+def flatten(root):
+    # names[i] is the symptom tested at i (None at leaves), so symptom lists are walked without encoding.
+    # A node shared by several parents (build_tree(shared=True)) gets one index.
+    features, yes, no, labels, names = [], [], [], [], []
+    indices = {}
+    if root is not None:
+        stack = [(root, -1, False)]
+        while stack:
+            node, parent, is_yes = stack.pop()
+            index = indices.get(node)
+            if index is not None:
+                (yes if is_yes else no)[parent] = index
+                continue
+            index = indices[node] = len(features)
+            if parent >= 0:
+                (yes if is_yes else no)[parent] = index
+            if node.yes_child and node.no_child:
+                features.append(vocabulary.bit(node.data))
+                names.append(node.data)
+                labels.append(None)
+                stack.append((node.no_child, index, False))
+                stack.append((node.yes_child, index, True))
+            else:
+                features.append(0)
+                names.append(None)
+                labels.append(node.data)
+            yes.append(-1)
+            no.append(-1)
+    return features, yes, no, labels, names
+
+class ResultCache:
+    # Bounded LRU of diagnose results keyed by the input projected onto the symptoms the tree tests.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self):
+        self.results.clear()
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.results), "hit_rate": self.hits / lookups if lookups else 0.0}
+
 
 class Diagnoser:
     def __init__(self, root):
+        self.result_cache = None
         self.root = root
+        self.search_stats = None
 
-    def diagnose(self, symptoms):
+    @property
+    def root(self):
+        return self.nodes
+
+    @root.setter
+    def root(self, node):
+        self.nodes = node
+        self.compiled = None
+        self.__dict__.pop("diagnose", None)
+        self.flat = None
+        self.tree_mask = None
+        self.illness_index = None
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def compile(self):
+        # A tree small enough to generate also gets its nested if/else source as an instance diagnose, which
+        # skips the method's dispatch. Masks walk the arrays; a result cache and instrumentation fall back
+        # to the method.
+        self.compiled = self.flattened()
+        self.__dict__.pop("diagnose", None)
+        if 0 < len(self.compiled[0]) <= MAX_COMPILED_NODES:
+            try:
+                source = self.function_source("set", guard=True)
+            except ValueError:
+                return self
+            features, yes, no, labels, _ = self.compiled
+            namespace = {"owner": self, "module": sys.modules[__name__],
+                         "fallback": types.MethodType(type(self).diagnose, self),
+                         "features": features, "yes": yes, "no": no, "labels": labels}
+            exec(compile(source, "<diagnoser>", "exec"), namespace)
+            self.diagnose = namespace["diagnose"]
+        return self
+
+    def flattened(self):
+        # flatten(root), kept until root changes. Flattening registers every tested symptom in the
+        # vocabulary, so inputs must be encoded after this call or those symptoms are dropped.
+        if self.flat is None:
+            self.flat = flatten(self.root)
+        return self.flat
+
+    def cache(self, maxsize=1024):
+        self.result_cache = ResultCache(maxsize) if maxsize else None
+        return self
+
+    def cache_info(self):
+        return self.result_cache.info() if self.result_cache is not None else None
+
+    def tested_mask(self):
+        if self.tree_mask is not None:
+            return self.tree_mask
+        mask = 0
+        seen = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or id(node) in seen:
+                continue
+            seen.add(id(node))
+            if node.yes_child and node.no_child:
+                mask |= vocabulary.bit(node.data)
+                stack += [node.yes_child, node.no_child]
+        self.tree_mask = mask
+        return mask
+
+    def path_length(self, symptoms):
+        self.tested_mask()
+        mask = vocabulary.known_mask(symptoms)
         node = self.root
+        length = 1
+        while node.yes_child and node.no_child:
+            node = node.yes_child if mask & vocabulary.bit(node.data) else node.no_child
+            length += 1
+        return length
+
+    def diagnose(self, symptoms):
+        if self.result_cache is not None or instrumentation is not None:
+            return self.observed_diagnose(symptoms)
+        if self.compiled is None:
+            node = self.nodes
+            try:
+                while node.yes_child and node.no_child:
+                    if node.data in symptoms:
+                        node = node.yes_child
+                    else:
+                        node = node.no_child
+            except TypeError:
+                if not isinstance(symptoms, int):
+                    raise
+                return self.walk(symptoms)
+            return node.data
+        features, yes, no, labels, names = self.compiled
+        i = 0
+        if isinstance(symptoms, int):
+            while feature := features[i]:
+                i = yes[i] if symptoms & feature else no[i]
+        else:
+            while (name := names[i]) is not None:
+                i = yes[i] if name in symptoms else no[i]
+        return labels[i]
+
+    def walk(self, mask):
+        # Uncached diagnosis of a known-symptom mask, for the cache and instrumentation path.
+        if self.compiled is not None:
+            features, yes, no, labels, _ = self.compiled
+            i = 0
+            while feature := features[i]:
+                i = yes[i] if mask & feature else no[i]
+            return labels[i]
+        node = self.nodes
         while node.yes_child and node.no_child:
-            if node.data in symptoms:
-                node = node.yes_child
+            node = node.yes_child if mask & vocabulary.bit(node.data) else node.no_child
+        return node.data
+
+    def observed_diagnose(self, symptoms):
+        # tested_mask registers the tree's symptoms, so it runs before the input is encoded.
+        tree_mask = self.tested_mask()
+        mask = vocabulary.known_mask(symptoms)
+        if instrumentation is not None:
+            # Counted with a second walk so the uninstrumented paths carry no counter.
+            instrumentation.count("diagnose_calls")
+            instrumentation.count("diagnose_nodes_visited", self.path_length(mask))
+        cache = self.result_cache
+        if cache is None:
+            return self.walk(mask)
+        key = mask & tree_mask
+        if key in cache.results:
+            cache.hits += 1
+            cache.results.move_to_end(key)
+            return cache.results[key]
+        cache.misses += 1
+        # Only tested symptoms matter, so the projected mask answers for every input with this key.
+        result = cache.results[key] = self.walk(key)
+        if len(cache.results) > cache.maxsize:
+            cache.results.popitem(last=False)
+            cache.evictions += 1
+        return result
+
+    def function_source(self, mode="mask", guard=False):
+        # Nested if/else over the tree. A subtree reached from more than one parent (build_tree(shared=True))
+        # becomes its own function, so the source stays the size of the DAG. Bits are resolved through the
+        # vocabulary when the source is run, so a cached source file stays valid in another process.
+        # guard=True is compile()'s entry point: masks walk the compiled arrays, caching and instrumentation
+        # go to fallback.
+        if mode not in ("mask", "set"):
+            raise ValueError("mode must be 'mask' or 'set'.")
+        argument = "mask" if mode == "mask" else "symptoms"
+        parents = Counter()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.yes_child and node.no_child:
+                for child in (node.yes_child, node.no_child):
+                    parents[child] += 1
+                    if parents[child] == 1:
+                        stack.append(child)
+        helpers = {}
+        bit_names = {}
+        header, body = [], []
+        pending = [(self.root, "diagnose")]
+        while pending:
+            top, function_name = pending.pop()
+            if top is self.root:
+                body.append("def diagnose(symptoms):")
+                if guard:
+                    body.append("    if owner.result_cache is not None or module.instrumentation is not None:")
+                    body.append("        return fallback(symptoms)")
+                    body.append("    if isinstance(symptoms, int):")
+                    body.append("        i = 0")
+                    body.append("        while feature := features[i]:")
+                    body.append("            i = yes[i] if symptoms & feature else no[i]")
+                    body.append("        return labels[i]")
+                if mode == "mask":
+                    body.append("    mask = known_mask(symptoms)")
             else:
-                node = node.no_child
+                body.append("def %s(%s):" % (function_name, argument))
+            stack = [(top, 1)]
+            while stack:
+                node, indent = stack.pop()
+                pad = "    " * indent
+                if isinstance(node, str):
+                    body.append(pad + node)
+                elif node.yes_child and node.no_child:
+                    if node is not top and parents[node] > 1:
+                        if node not in helpers:
+                            helpers[node] = "node%d" % len(helpers)
+                            pending.append((node, helpers[node]))
+                        body.append("%sreturn %s(%s)" % (pad, helpers[node], argument))
+                        continue
+                    if indent >= MAX_FUNCTION_DEPTH:
+                        raise ValueError("Tree is too deep to generate a function.")
+                    if mode == "mask":
+                        if node.data not in bit_names:
+                            bit_names[node.data] = "b%d" % len(bit_names)
+                            header.append("%s = bit(%r)" % (bit_names[node.data], node.data))
+                        body.append("%sif mask & %s:" % (pad, bit_names[node.data]))
+                    else:
+                        body.append("%sif %r in symptoms:" % (pad, node.data))
+                    stack += [(node.no_child, indent + 1), ("else:", indent), (node.yes_child, indent + 1)]
+                else:
+                    body.append("%sreturn %r" % (pad, node.data))
+        return "\n".join([self.function_header(mode)] + header + body) + "\n"
+
+    def function_header(self, mode):
+        # Identifies the tree and mode a cached source file was generated from.
+        _, yes, no, labels, names = self.flattened()
+        fingerprint = hashlib.sha256(repr((mode, yes, no, labels, names)).encode()).hexdigest()
+        return "# generated diagnose function, mode=%s, tree=%s" % (mode, fingerprint)
+
+    def to_function(self, mode="mask", path=None):
+        source = None
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                if file.readline().rstrip("\n") == self.function_header(mode):
+                    file.seek(0)
+                    source = file.read()
+        if source is None:
+            source = self.function_source(mode)
+            if path is not None:
+                with open(path, "w") as file:
+                    file.write(source)
+        namespace = {"bit": vocabulary.bit, "known_mask": vocabulary.known_mask}
+        exec(compile(source, path or "<diagnoser>", "exec"), namespace)
+        return namespace["diagnose"]
+
+    def walk_names(self, symptoms):
+        if self.compiled is not None:
+            _, yes, no, labels, names = self.compiled
+            i = 0
+            while (name := names[i]) is not None:
+                i = yes[i] if name in symptoms else no[i]
+            return labels[i]
+        node = self.nodes
+        while node.yes_child and node.no_child:
+            node = node.yes_child if node.data in symptoms else node.no_child
         return node.data
-    
+
+    def leaf_rows(self, matrix):
+        # Only cells holding rows are visited, so an uncompiled tree is walked without flattening all of it.
+        if self.compiled is not None:
+            features, yes, no, labels, _ = self.compiled
+            stack = [(0, matrix.all_rows)]
+            while stack:
+                i, rows = stack.pop()
+                feature = features[i]
+                if feature:
+                    yes_rows = rows & matrix.column(feature)
+                    if yes_rows:
+                        stack.append((yes[i], yes_rows))
+                    if rows != yes_rows:
+                        stack.append((no[i], rows ^ yes_rows))
+                else:
+                    yield labels[i], rows
+            return
+        stack = [(self.nodes, matrix.all_rows)]
+        while stack:
+            node, rows = stack.pop()
+            if node.yes_child and node.no_child:
+                yes_rows = rows & matrix.column(vocabulary.bit(node.data))
+                if yes_rows:
+                    stack.append((node.yes_child, yes_rows))
+                if rows != yes_rows:
+                    stack.append((node.no_child, rows ^ yes_rows))
+            else:
+                yield node.data, rows
+
+    def diagnose_many(self, records_or_symptom_lists):
+        # Symptom lists are walked by name, like diagnose, so nothing is encoded. The first record or mask
+        # makes "in" raise TypeError; from there on, records and masks are walked once per distinct mask,
+        # so a repeated row costs one dict lookup.
+        items = records_or_symptom_lists
+        if isinstance(items, SymptomMatrix):
+            items = items.masks
+        iterator = iter(items)
+        results = []
+        append = results.append
+        item = None
+        try:
+            if self.compiled is None:
+                root = self.nodes
+                for item in iterator:
+                    node = root
+                    while node.yes_child and node.no_child:
+                        if node.data in item:
+                            node = node.yes_child
+                        else:
+                            node = node.no_child
+                    append(node.data)
+            else:
+                _, yes, no, labels, names = self.compiled
+                for item in iterator:
+                    i = 0
+                    while (name := names[i]) is not None:
+                        if name in item:
+                            i = yes[i]
+                        else:
+                            i = no[i]
+                    append(labels[i])
+            return results
+        except TypeError:
+            if not isinstance(item, (Record, int)):
+                raise
+        answers = {}
+        by_mask = self.compiled is not None
+        for item in itertools.chain([item], iterator):
+            if isinstance(item, Record):
+                mask = item.mask
+            elif isinstance(item, int):
+                mask = item
+            else:
+                append(self.walk_names(item))
+                continue
+            label = answers.get(mask, answers)
+            if label is answers:
+                if by_mask or mask is item:
+                    label = answers[mask] = self.walk(mask)
+                else:
+                    label = answers[mask] = self.walk_names(item.symptoms)
+            append(label)
+        return results
+
+    @phase("calculate_success_rate")
     def calculate_success_rate(self, records):
-        if not records:
+        # Lists and streams are scored in bounded chunks, so an iter_records() stream runs in constant memory.
+        if isinstance(records, SymptomMatrix) and records.illnesses is None:
+            raise TypeError("Symptom matrix must be built from records.")
+        chunks = [records] if isinstance(records, SymptomMatrix) else iter_chunks(records, STREAM_CHUNK_SIZE)
+        successes = total = 0
+        for chunk in chunks:
+            if isinstance(chunk, SymptomMatrix):
+                successes += sum(chunk.count(rows & chunk.illness_rows.get(label, 0))
+                                 for label, rows in self.leaf_rows(chunk))
+                total += chunk.total
+            elif len(chunk) >= BATCH_THRESHOLD:
+                # Building a SymptomMatrix costs more than it saves here; diagnose_many walks each mask once.
+                labels = self.diagnose_many(chunk)
+                successes += sum(record.count for record, label in zip(chunk, labels) if label == record.illness)
+                total += total_count(chunk)
+            elif self.compiled is not None:
+                successes += sum(record.count for record in chunk if self.diagnose(record.mask) == record.illness)
+                total += total_count(chunk)
+            else:
+                successes += sum(record.count for record in chunk if self.diagnose(record.symptoms) == record.illness)
+                total += total_count(chunk)
+        if not total:
             raise ValueError("Records list is empty")
-        successes = sum(1 for record in records if self.diagnose(record.symptoms) == record.illness)
-        return successes / len(records)
+        return successes / total
 
-    def all_illnesses(self):
-        illness_count = {}
-
-        def traverse(node):
+    def build_illness_index(self):
+        # illness -> leaf paths, each packed as (bits, length) with the first step most significant
+        # and 0 for yes, in the same yes-first order as a recursive walk.
+        index = {}
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, bits, length = stack.pop()
             if node.yes_child is None and node.no_child is None:
-                if node.data:
-                    illness_count[node.data] = illness_count.get(node.data, 0) + 1
-            else:
-                traverse(node.yes_child)
-                traverse(node.no_child)
+                index.setdefault(node.data, []).append((bits, length))
+                continue
+            if node.no_child is not None:
+                stack.append((node.no_child, bits << 1 | 1, length + 1))
+            if node.yes_child is not None:
+                stack.append((node.yes_child, bits << 1, length + 1))
+        return index
 
-        traverse(self.root)
+    def leaf_paths(self):
+        if self.illness_index is None:
+            self.illness_index = self.build_illness_index()
+        return self.illness_index
+
+    def all_illnesses(self):
+        illness_count = {illness: len(paths) for illness, paths in self.leaf_paths().items() if illness}
         return sorted(illness_count, key=lambda illness: -illness_count[illness])
 
+    def iter_paths_to_illness(self, illness):
+        for bits, length in self.leaf_paths().get(illness, ()):
+            yield [not bits >> (length - 1 - step) & 1 for step in range(length)]
+
     def paths_to_illness(self, illness):
-        paths = []
+        return list(self.iter_paths_to_illness(illness))
 
-        def traverse(node, path):
-            if node.yes_child is None and node.no_child is None:
-                if node.data == illness:
-                    paths.append(path)
-            else:
-                traverse(node.yes_child, path + [True])
-                traverse(node.no_child, path + [False])
+    def save(self, path):
+        # Nodes are numbered children first (shared subtrees once), so load can build them in file order.
+        names, ids = [], {}
+        index = {None: -1}
+        rows = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack[-1]
+            if node in index:
+                stack.pop()
+                continue
+            pending = [child for child in (node.no_child, node.yes_child) if child not in index]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            if node.data is not None and not isinstance(node.data, str):
+                raise TypeError("Node data must be a string or None.")
+            name = -1 if node.data is None else ids.setdefault(node.data, len(ids))
+            if name == len(names):
+                names.append(node.data)
+            index[node] = len(rows)
+            rows.append((name, index[node.yes_child], index[node.no_child]))
+        blob = "\n".join(names).encode()
+        blob += b"\0" * (-len(blob) % 4)
+        with open(path, "wb") as file:
+            file.write(MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION, len(rows), len(names), len(blob)))
+            file.write(blob)
+            file.write(struct.pack("<%di" % (3 * len(rows)), *itertools.chain.from_iterable(rows)))
 
-        traverse(self.root, [])
-        return paths
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < MODEL_HEADER.size:
+                raise ValueError("Model file is truncated")
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with buffer, memoryview(buffer) as view:
+            magic, version, count, name_count, names_size = MODEL_HEADER.unpack_from(view)
+            if magic != MODEL_MAGIC:
+                raise ValueError("Not a saved Diagnoser")
+            if version != MODEL_VERSION:
+                raise ValueError("Unsupported model version %d" % version)
+            offset = MODEL_HEADER.size
+            names = bytes(view[offset:offset + names_size]).rstrip(b"\0").decode().split("\n") if name_count else []
+            offset += names_size
+            with view[offset:offset + 12 * count].cast("i") as table:
+                values = table.tolist()
+        nodes = []
+        for i in range(0, 3 * count, 3):
+            name, yes, no = values[i:i + 3]
+            nodes.append(Node(None if name < 0 else names[name],
+                              None if yes < 0 else nodes[yes], None if no < 0 else nodes[no]))
+        return Diagnoser(nodes[-1] if nodes else None)
 
+    @phase("minimize")
     def minimize(self, remove_empty=False):
-        def are_subtrees_identical(node1, node2):
-            if node1 is None and node2 is None:
-                return True
-            if node1 is None or node2 is None:
-                return False
-            if is_leaf(node1) and is_leaf(node2):
-                return node1.data == node2.data
-            if is_leaf(node1) or is_leaf(node2):
-                return False
-            return (node1.data == node2.data and 
-                    are_subtrees_identical(node1.yes_child, node2.yes_child) and 
-                    are_subtrees_identical(node1.no_child, node2.no_child))
-
-        def all_paths_lead_to_none(node):
-            if node is None:
-                return True
-            if is_leaf(node):
-                return node.data is None
-            return all_paths_lead_to_none(node.yes_child) and all_paths_lead_to_none(node.no_child)
-
-        def helper(node):
-            if node is None or is_leaf(node):
-                return node
-
-            # Process children first (bottom-up)
-            node.yes_child = helper(node.yes_child)
-            node.no_child = helper(node.no_child)
-
-            # For remove_empty=True case
-            if remove_empty:
-                if all_paths_lead_to_none(node.yes_child):
-                    return node.no_child
-                if all_paths_lead_to_none(node.no_child):
-                    return node.yes_child
-
-            # Check if subtrees are identical
-            if are_subtrees_identical(node.yes_child, node.no_child):
-                # If they're identical, can return either child
-                return node.yes_child
-
-            return node
+        # One iterative bottom-up pass. Each kept subtree gets a canonical id (equal ids mean identical
+        # subtrees) and an "all paths lead to None" flag, so no subtree is walked twice.
+        canonical_ids = {}
+        # node -> (node it minimizes to, canonical id, all paths lead to None)
+        info = {None: (None, 0, True)}
+        comparisons = 0
+        stack = [self.root]
+        while stack:
+            node = stack[-1]
+            if node in info:
+                stack.pop()
+                continue
+            if node.yes_child is None and node.no_child is None:
+                stack.pop()
+                info[node] = (node, canonical_ids.setdefault(("leaf", node.data), len(canonical_ids) + 1),
+                              node.data is None)
+                continue
+            # Process children first (bottom-up); shared children are only processed once
+            if node.no_child not in info:
+                stack.append(node.no_child)
+            if node.yes_child not in info:
+                stack.append(node.yes_child)
+            if stack[-1] is not node:
+                continue
+            stack.pop()
+
+            comparisons += 1
+            yes_child, yes_id, yes_empty = info[node.yes_child]
+            no_child, no_id, no_empty = info[node.no_child]
+            node.yes_child = yes_child
+            node.no_child = no_child
+
+            if remove_empty and yes_empty:
+                info[node] = info[no_child]
+            elif remove_empty and no_empty:
+                info[node] = info[yes_child]
+            elif yes_id == no_id:
+                info[node] = info[yes_child]
+            else:
+                info[node] = (node, canonical_ids.setdefault((node.data, yes_id, no_id), len(canonical_ids) + 1),
+                              yes_empty and no_empty)
 
+        if instrumentation is not None:
+            instrumentation.count("minimize_subtree_comparisons", comparisons)
         if self.root is not None:
             # If all paths lead to None and remove_empty is True, replace with single None node
-            if remove_empty and all_paths_lead_to_none(self.root):
-                self.root = Node(None)
-            else:
-                self.root = helper(self.root)
+            root, _, root_empty = info[self.root]
+            self.root = Node(None) if remove_empty and root_empty else root
+
+
+
+
+
 
 
 
@@ -131,26 +894,207 @@ class Diagnoser:
 
 
 
+class HeapDiagnoser(Diagnoser):
+    # A build_tree tree is complete and level i always tests symptoms[i], so only the leaves are stored.
+    # Leaf j is reached by the path whose bits, most significant first, are 0 for yes and 1 for no.
+    # Touching root converts to Node form, after which every method falls back to Diagnoser.
+    def __init__(self, symptoms, leaves):
+        super().__init__(None)
+        self.symptoms = list(symptoms)
+        self.bits = [vocabulary.bit(symptom) for symptom in symptoms]
+        self.leaves = leaves
 
+    @property
+    def root(self):
+        if self.leaves is not None:
+            self.nodes = self.to_nodes()
+            self.leaves = None
+        return self.nodes
 
+    @root.setter
+    def root(self, node):
+        self.leaves = None
+        Diagnoser.root.fset(self, node)
 
+    def to_nodes(self):
+        level = [Node(label) for label in self.leaves]
+        for symptom in reversed(self.symptoms):
+            level = [Node(symptom, level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        return level[0]
+
+    def leaf_index(self, mask):
+        index = 0
+        for bit in self.bits:
+            index = index << 1 | (not mask & bit)
+        return index
+
+    def compile(self):
+        if self.leaves is None:
+            return super().compile()
+        return self
+
+    def tested_mask(self):
+        if self.leaves is None:
+            return super().tested_mask()
+        return sum(set(self.bits))
+
+    def diagnose(self, symptoms):
+        if self.leaves is None or self.result_cache is not None or instrumentation is not None:
+            return super().diagnose(symptoms)
+        return self.leaves[self.leaf_index(vocabulary.known_mask(symptoms))]
 
+    def walk(self, mask):
+        if self.leaves is None:
+            return super().walk(mask)
+        return self.leaves[self.leaf_index(mask)]
 
-def build_tree(records, symptoms):
+    def leaf_rows(self, matrix):
+        if self.leaves is None:
+            yield from super().leaf_rows(matrix)
+            return
+        stack = [(0, 0, matrix.all_rows)]
+        while stack:
+            index, level, rows = stack.pop()
+            if level == len(self.bits):
+                yield self.leaves[index], rows
+                continue
+            yes_rows = rows & matrix.column(self.bits[level])
+            if yes_rows:
+                stack.append((index << 1, level + 1, yes_rows))
+            if rows != yes_rows:
+                stack.append((index << 1 | 1, level + 1, rows ^ yes_rows))
+
+    def diagnose_many(self, records_or_symptom_lists):
+        if self.leaves is None:
+            return super().diagnose_many(records_or_symptom_lists)
+        return [self.leaves[self.leaf_index(mask)] for mask in batch_masks(records_or_symptom_lists)]
+
+    def all_illnesses(self):
+        if self.leaves is None:
+            return super().all_illnesses()
+        illness_count = Counter(label for label in self.leaves if label)
+        return sorted(illness_count, key=lambda illness: -illness_count[illness])
+
+    def path_length(self, symptoms):
+        if self.leaves is None:
+            return super().path_length(symptoms)
+        return len(self.bits) + 1
+
+    def iter_paths_to_illness(self, illness):
+        if self.leaves is None:
+            yield from super().iter_paths_to_illness(illness)
+            return
+        depth = len(self.bits)
+        for index, label in enumerate(self.leaves):
+            if label == illness:
+                yield [not index >> (depth - 1 - level) & 1 for level in range(depth)]
+
+
+class LazyLeaves:
+    # Leaf labels of a HeapDiagnoser computed on first use. Each expanded cell keeps its record subset,
+    # keyed by (level, path prefix), in an LRU bounded by node_budget; evicted cells are re-split from
+    # their parent on the next visit. Iterating computes every leaf (full expansion). records may also be
+    # a SymptomMatrix, whose cells are row bitsets.
+    def __init__(self, records, symptoms, node_budget=None):
+        self.matrix = records if isinstance(records, SymptomMatrix) else None
+        self.records = records.all_rows if self.matrix is not None else records
+        self.bits = [vocabulary.bit(symptom) for symptom in symptoms]
+        self.node_budget = node_budget
+        self.cells = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return 1 << len(self.bits)
+
+    def part(self, cell, bit, yes):
+        if self.matrix is None:
+            return [record for record in cell if bool(record.mask & bit) == yes]
+        column = self.matrix.column(bit)
+        return cell & column if yes else cell & ~column
+
+    def label(self, cell):
+        return most_common_illness(cell) if self.matrix is None else self.matrix.majority_illness(cell)
+
+    def remember(self, key, value):
+        self.cells[key] = value
+        if self.node_budget is not None and len(self.cells) > self.node_budget:
+            self.cells.popitem(last=False)
+            self.evictions += 1
+
+    def __getitem__(self, index):
+        depth = len(self.bits)
+        leaf_key = (depth, index)
+        if leaf_key in self.cells:
+            self.cells.move_to_end(leaf_key)
+            return self.cells[leaf_key]
+        records = self.records
+        for level, bit in enumerate(self.bits):
+            key = (level + 1, index >> (depth - 1 - level))
+            if key == leaf_key:
+                break
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = self.part(records, bit, not key[1] & 1)
+                self.remember(key, cell)
+            else:
+                self.cells.move_to_end(key)
+            records = cell
+        if depth:
+            records = self.part(records, self.bits[-1], not index & 1)
+        label = self.label(records)
+        self.remember(leaf_key, label)
+        return label
+
+    def __iter__(self):
+        cells = [self.records]
+        for bit in self.bits:
+            cells = [part for cell in cells for part in (self.part(cell, bit, True), self.part(cell, bit, False))]
+        return (self.label(cell) for cell in cells)
+
+
+def most_common_illness(records):
+    illnesses = Counter()
+    for record in records:
+        illnesses[record.illness] += record.count
+    most_common = illnesses.most_common(1)
+    return most_common[0][0] if most_common else None
+
+
+@phase("build_tree")
+def build_tree(records, symptoms, heap=False, shared=False, lazy=False, node_budget=None):
+    if isinstance(records, SymptomMatrix):
+        return index_build_tree(records, symptoms, heap, shared, lazy, node_budget)
+    if not isinstance(records, (list, tuple)):
+        records = deduplicate_records(require_records(records))
     if not all(isinstance(record, Record) for record in records):
         raise TypeError("All elements in records must be of type Record.")
     if not all(isinstance(symptom, str) for symptom in symptoms):
         raise TypeError("All elements in symptoms must be strings.")
 
+    if lazy:
+        return HeapDiagnoser(symptoms, LazyLeaves(records, symptoms, node_budget))
+    if heap:
+        if instrumentation is not None:
+            instrumentation.count("records_split", len(records) * len(symptoms))
+        cells = [records]
+        for symptom in symptoms:
+            bit = vocabulary.bit(symptom)
+            cells = [part for cell in cells for part in ([record for record in cell if record.mask & bit],
+                                                         [record for record in cell if not record.mask & bit])]
+        return HeapDiagnoser(symptoms, [most_common_illness(cell) for cell in cells])
+    if shared:
+        return Diagnoser(shared_build(records, symptoms, most_common_illness, split_records))
+
     def build_recursive(records_subset, remaining_symptoms):
         if not remaining_symptoms:  # If no symptoms left, return the most common illness
-            illnesses = [record.illness for record in records_subset]
-            most_common = Counter(illnesses).most_common(1)
-            return Node(most_common[0][0] if most_common else None)
+            return Node(most_common_illness(records_subset))
 
+        if instrumentation is not None:
+            instrumentation.count("records_split", len(records_subset))
         symptom = remaining_symptoms[0]
-        yes_records = [record for record in records_subset if symptom in record.symptoms]
-        no_records = [record for record in records_subset if symptom not in record.symptoms]
+        bit = vocabulary.bit(symptom)
+        yes_records = [record for record in records_subset if record.mask & bit]
+        no_records = [record for record in records_subset if not record.mask & bit]
 
         yes_branch = build_recursive(yes_records, remaining_symptoms[1:])
         no_branch = build_recursive(no_records, remaining_symptoms[1:])
@@ -160,25 +1104,544 @@ def build_tree(records, symptoms):
     return Diagnoser(build_recursive(records, symptoms))
 
 
-def optimal_tree(records, symptoms, depth):
+def split_records(records, symptom):
+    bit = vocabulary.bit(symptom)
+    return [record for record in records if record.mask & bit], [record for record in records if not record.mask & bit]
+
+
+def shared_build(cell, symptoms, label_of, split):
+    # Hash-consed build_tree: nodes are interned by (symptom, yes id, no id) or leaf label, so the result
+    # is a DAG sized by its distinct subtrees. Empty cells are built once per level, which keeps the
+    # work proportional to the non-empty cells rather than 2^len(symptoms).
+    unique = {}
+    empty = {}
+
+    def build_recursive(cell, level):
+        if not cell and level in empty:
+            return empty[level]
+        if level == len(symptoms):
+            label = label_of(cell)
+            node = unique.setdefault(("leaf", label), Node(label))
+        else:
+            yes_cell, no_cell = split(cell, symptoms[level])
+            yes_branch = build_recursive(yes_cell, level + 1)
+            no_branch = build_recursive(no_cell, level + 1)
+            node = unique.setdefault((symptoms[level], id(yes_branch), id(no_branch)),
+                                     Node(symptoms[level], yes_branch, no_branch))
+        if not cell:
+            empty[level] = node
+        return node
+
+    return build_recursive(cell, 0)
+
+
+def index_build_tree(matrix, symptoms, heap=False, shared=False, lazy=False, node_budget=None):
+    if matrix.illnesses is None:
+        raise TypeError("Symptom matrix must be built from records.")
+    if not all(isinstance(symptom, str) for symptom in symptoms):
+        raise TypeError("All elements in symptoms must be strings.")
+
+    if lazy:
+        return HeapDiagnoser(symptoms, LazyLeaves(matrix, symptoms, node_budget))
+
+    if heap:
+        cells = [matrix.all_rows]
+        for symptom in symptoms:
+            column = matrix.column(vocabulary.bit(symptom))
+            cells = [part for rows in cells for part in (rows & column, rows & ~column)]
+        return HeapDiagnoser(symptoms, [matrix.majority_illness(rows) for rows in cells])
+    if shared:
+        def split_rows(rows, symptom):
+            yes_rows = rows & matrix.column(vocabulary.bit(symptom))
+            return yes_rows, rows ^ yes_rows
+
+        return Diagnoser(shared_build(matrix.all_rows, symptoms, matrix.majority_illness, split_rows))
+
+    def build_recursive(rows, remaining_symptoms):
+        if not remaining_symptoms:
+            return Node(matrix.majority_illness(rows))
+
+        if instrumentation is not None:
+            instrumentation.count("records_split", rows.bit_count())
+        symptom = remaining_symptoms[0]
+        yes_rows = rows & matrix.column(vocabulary.bit(symptom))
+
+        yes_branch = build_recursive(yes_rows, remaining_symptoms[1:])
+        no_branch = build_recursive(rows ^ yes_rows, remaining_symptoms[1:])
+
+        return Node(symptom, yes_branch, no_branch)
+
+    return Diagnoser(build_recursive(matrix.all_rows, symptoms))
+
+
+def weighted_rows(records):
+    rows = Counter()
+    for record in records:
+        rows[record.mask, record.illness] += record.count
+    return list(rows.items())
+
+
+def count_successes(rows, subset_mask):
+    # Training accuracy of build_tree: each cell of the partition scores its majority illness.
+    cells = {}
+    for (mask, illness), count in rows:
+        cell = cells.setdefault(mask & subset_mask, {})
+        cell[illness] = cell.get(illness, 0) + count
+    return sum(max(cell.values()) for cell in cells.values())
+
+
+def split_cells(cells, bit):
+    refined = []
+    for cell in cells:
+        yes_rows = [row for row in cell if row[0][0] & bit]
+        if yes_rows:
+            refined.append(yes_rows)
+        if len(yes_rows) < len(cell):
+            refined.append([row for row in cell if not row[0][0] & bit])
+    return refined
+
+
+def last_level_successes(cells, bits, start):
+    # Scores every one-symptom extension of a prefix in a single pass over its cells.
+    positions = {bits[i]: i for i in range(start, len(bits))}
+    candidates_mask = sum(positions)
+    successes = [0] * len(bits)
+    for cell in cells:
+        totals = {}
+        yes_counts = {}
+        for (mask, illness), count in cell:
+            totals[illness] = totals.get(illness, 0) + count
+            mask &= candidates_mask
+            while mask:
+                low = mask & -mask
+                counts = yes_counts.setdefault(positions[low], {})
+                counts[illness] = counts.get(illness, 0) + count
+                mask ^= low
+        cell_majority = max(totals.values())
+        for i in range(start, len(bits)):
+            counts = yes_counts.get(i)
+            if counts is None:
+                successes[i] += cell_majority
+            else:
+                successes[i] += max(counts.values()) + max(
+                    (total - counts.get(illness, 0) for illness, total in totals.items()))
+    return successes
+
+
+def combination_rank(indices, n, k):
+    # Position of a sorted index tuple in itertools.combinations(range(n), k) order.
+    rank = 0
+    previous = -1
+    for position, index in enumerate(indices):
+        for skipped in range(previous + 1, index):
+            rank += math.comb(n - 1 - skipped, k - 1 - position)
+        previous = index
+    return rank
+
+
+def combination_at(rank, n, k):
+    indices = []
+    index = 0
+    for position in range(k):
+        while rank >= (block := math.comb(n - 1 - index, k - 1 - position)):
+            rank -= block
+            index += 1
+        indices.append(index)
+        index += 1
+    return indices
+
+
+class SearchProgress:
+    # Time budget, on_progress reporting and checkpoints shared by the optimal_tree searches. stats
+    # becomes the result's search_stats; "complete" turns False once the budget runs out.
+    def __init__(self, total, perfect, time_budget=None, on_progress=None, checkpoint=None, checkpoint_interval=60,
+                 data_digest=None):
+        self.data_digest = data_digest
+        self.stats = {"evaluated": 0, "skipped": 0, "complete": True}
+        self.total = total
+        self.perfect = perfect
+        self.start = time.monotonic()
+        self.deadline = None if time_budget is None else self.start + time_budget
+        self.on_progress = on_progress
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = self.start
+        self.stopped_saved = False
+        self.symptoms = None
+        self.depth = 0
+        self.resume_index = 0
+        self.resume_at = None
+        self.caller_positions = None
+
+    def rank_ties_in(self, caller_symptoms):
+        # The search runs in a reordered symptom list; ties still go to the subset that comes first in
+        # itertools.combinations over the caller's order, as in an unordered search.
+        self.caller_positions = {symptom: i for i, symptom in enumerate(caller_symptoms)}
+
+    @property
+    def reordered(self):
+        return self.caller_positions is not None
+
+    def caller_rank(self, subset):
+        return combination_rank(sorted(self.caller_positions[symptom] for symptom in subset),
+                                len(self.caller_positions), len(subset))
+
+    def beats(self, successes, subset, best_successes, best_subset):
+        if successes != best_successes or best_subset is None or not self.reordered:
+            return successes > best_successes
+        return self.caller_rank(subset) < self.caller_rank(best_subset)
+
+    def cannot_win(self, bound, best_successes):
+        # A reordered search keeps prefixes that can only tie: they may hold an earlier subset.
+        return bound < best_successes or (bound == best_successes and not self.reordered)
+
+    def saved_symptoms(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as file:
+            return json.load(file).get("symptoms")
+
+    def begin(self, symptoms, depth):
+        # Returns the best (subset, successes) recorded in an existing checkpoint, else (None, 0).
+        self.symptoms = list(symptoms)
+        self.depth = depth
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None, 0
+        with open(self.checkpoint) as file:
+            state = json.load(file)
+        if (state.get("version") != CHECKPOINT_VERSION or state["symptoms"] != self.symptoms
+                or state["depth"] != depth or state["perfect"] != self.perfect
+                or state["data"] != self.data_digest):
+            raise ValueError("Checkpoint does not match this search.")
+        self.stats["evaluated"] = state["evaluated"]
+        self.stats["skipped"] = state["skipped"]
+        self.resume_index = state["index"]
+        if self.resume_index < self.total:
+            self.resume_at = combination_at(self.resume_index, len(self.symptoms), depth)
+        best_subset = state["best_subset"]
+        return (None if best_subset is None else tuple(best_subset)), state["best_successes"]
+
+    def resumed_past(self, indices):
+        # True when every combination starting with indices was finished before the checkpoint.
+        return self.resume_index >= self.total or (
+            self.resume_at is not None and indices < self.resume_at[:len(indices)])
+
+    def save(self, index, best_subset, best_successes, force=False):
+        if self.checkpoint is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_checkpoint < self.checkpoint_interval:
+            return
+        self.last_checkpoint = now
+        state = {"version": CHECKPOINT_VERSION, "symptoms": self.symptoms, "depth": self.depth,
+                 "perfect": self.perfect, "data": self.data_digest, "index": index, "total": self.total,
+                 "evaluated": self.stats["evaluated"], "skipped": self.stats["skipped"],
+                 "best_subset": None if best_subset is None else list(best_subset),
+                 "best_successes": best_successes}
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(state, file)
+        os.replace(temporary, self.checkpoint)
+
+    def save_branch(self, chosen, best_subset, best_successes):
+        # Everything before the first combination starting with chosen is done. After a stop only the
+        # innermost loop saves, since it knows the furthest point reached.
+        if self.checkpoint is None:
+            return
+        first = chosen + list(range(chosen[-1] + 1, chosen[-1] + 1 + self.depth - len(chosen)))
+        index = combination_rank(first, len(self.symptoms), self.depth)
+        if self.stats["complete"]:
+            self.save(index, best_subset, best_successes)
+        elif not self.stopped_saved:
+            self.stopped_saved = True
+            self.save(index, best_subset, best_successes, force=True)
+
+    def first_candidate(self, chosen, start):
+        if self.resume_at is not None and chosen == self.resume_at[:-1]:
+            return max(start, self.resume_at[-1])
+        return start
+
+    def finish(self, best_subset, best_successes):
+        if self.stats["complete"]:
+            self.save(self.total, best_subset, best_successes, force=True)
+        elif not self.stopped_saved:
+            self.save(self.resume_index, best_subset, best_successes, force=True)
+        self.report(best_subset, best_successes)
+
+    def expired(self):
+        if self.deadline is not None and self.stats["complete"] and time.monotonic() >= self.deadline:
+            self.stats["complete"] = False
+        return not self.stats["complete"]
+
+    def report(self, best_subset, best_successes):
+        if self.on_progress is not None:
+            self.on_progress(dict(self.stats, total=self.total, best_subset=best_subset,
+                                  best_accuracy=best_successes / self.perfect if self.perfect else 0.0,
+                                  elapsed=time.monotonic() - self.start))
+
+
+@phase("optimal_tree_search")
+def prefix_search(rows, symptoms, depth, prune=True, progress=None):
+    # Walks itertools.combinations order depth-first, refining the partition of the shared prefix
+    # by one symptom per level instead of re-splitting every subset from scratch. Refining never
+    # lowers training accuracy, so a prefix split by every remaining symptom bounds all of its
+    # completions; prefixes whose bound cannot beat the best subset so far are skipped.
+    bits = [vocabulary.bit(symptom) for symptom in symptoms]
+    perfect = sum(count for _, count in rows)
+    progress = progress or SearchProgress(math.comb(len(symptoms), depth), perfect)
+    best_subset, best_successes = progress.begin(symptoms, depth)
+    stats = progress.stats
+
+    def search(cells, start, chosen, prefix_mask):
+        nonlocal best_subset, best_successes
+        remaining = depth - len(chosen)
+        if progress.expired():
+            return
+        if (best_successes == perfect and not progress.reordered) or (
+                prune and remaining > 1 and
+                progress.cannot_win(count_successes(rows, prefix_mask | sum(bits[start:])), best_successes)):
+            stats["skipped"] += math.comb(len(symptoms) - start, remaining)
+            return
+        if remaining == 1:
+            start = progress.first_candidate(chosen, start)
+            successes = last_level_successes(cells, bits, start)
+            stats["evaluated"] += len(symptoms) - start
+            previous = best_subset
+            for i in range(start, len(symptoms)):
+                if successes[i] >= best_successes:
+                    subset = tuple(symptoms[j] for j in chosen) + (symptoms[i],)
+                    if progress.beats(successes[i], subset, best_successes, best_subset):
+                        best_subset, best_successes = subset, successes[i]
+            if best_subset != previous:
+                progress.report(best_subset, best_successes)
+            return
+        for i in range(start, len(symptoms) - remaining + 1):
+            chosen.append(i)
+            if not progress.resumed_past(chosen):
+                progress.save_branch(chosen, best_subset, best_successes)
+                search(split_cells(cells, bits[i]), i + 1, chosen, prefix_mask | bits[i])
+                if progress.expired():
+                    progress.save_branch(chosen, best_subset, best_successes)
+                    chosen.pop()
+                    return
+            chosen.pop()
+
+    if depth == 0:
+        stats["evaluated"] = 1
+        return (), stats
+    if not progress.resumed_past([]):
+        search([rows], 0, [], 0)
+    progress.finish(best_subset, best_successes)
+    return best_subset, stats
+
+
+@phase("optimal_tree_search")
+def index_search(matrix, symptoms, depth, prune=True, progress=None):
+    # prefix_search over a SymptomMatrix: partition cells are row bitsets and every count is a popcount.
+    columns = [matrix.column(vocabulary.bit(symptom)) for symptom in symptoms]
+    perfect = matrix.total
+    progress = progress or SearchProgress(math.comb(len(symptoms), depth), perfect)
+    best_subset, best_successes = progress.begin(symptoms, depth)
+    stats = progress.stats
+
+    def refine(cells, column):
+        refined = []
+        for cell in cells:
+            yes_rows = cell & column
+            if yes_rows:
+                refined.append(yes_rows)
+            if yes_rows != cell:
+                refined.append(cell ^ yes_rows)
+        return refined
+
+    def bound(cells, start):
+        for column in columns[start:]:
+            cells = refine(cells, column)
+        return sum(matrix.majority(cell) for cell in cells)
+
+    def search(cells, start, chosen):
+        nonlocal best_subset, best_successes
+        remaining = depth - len(chosen)
+        if progress.expired():
+            return
+        if (best_successes == perfect and not progress.reordered) or (
+                prune and remaining > 1 and progress.cannot_win(bound(cells, start), best_successes)):
+            stats["skipped"] += math.comb(len(symptoms) - start, remaining)
+            return
+        if remaining == 1:
+            start = progress.first_candidate(chosen, start)
+            stats["evaluated"] += len(symptoms) - start
+            previous = best_subset
+            for i in range(start, len(symptoms)):
+                successes = 0
+                for cell in cells:
+                    yes_rows = cell & columns[i]
+                    successes += matrix.majority(yes_rows) + matrix.majority(cell ^ yes_rows)
+                if successes >= best_successes:
+                    subset = tuple(symptoms[j] for j in chosen) + (symptoms[i],)
+                    if progress.beats(successes, subset, best_successes, best_subset):
+                        best_subset, best_successes = subset, successes
+            if best_subset != previous:
+                progress.report(best_subset, best_successes)
+            return
+        for i in range(start, len(symptoms) - remaining + 1):
+            chosen.append(i)
+            if not progress.resumed_past(chosen):
+                progress.save_branch(chosen, best_subset, best_successes)
+                search(refine(cells, columns[i]), i + 1, chosen)
+                if progress.expired():
+                    progress.save_branch(chosen, best_subset, best_successes)
+                    chosen.pop()
+                    return
+            chosen.pop()
+
+    if depth == 0:
+        stats["evaluated"] = 1
+        return (), stats
+    if not progress.resumed_past([]):
+        search([matrix.all_rows], 0, [])
+    progress.finish(best_subset, best_successes)
+    return best_subset, stats
+
+
+SEARCH_CHUNK_SIZE = 4096
+search_rows = None
+
+def init_search_worker(rows):
+    global search_rows
+    search_rows = rows
+
+
+def search_chunk(subset_masks):
+    # Offsets of every subset with the best score, so a reordered search can pick among ties.
+    best_offsets = []
+    best_successes = 0
+    for offset, subset_mask in enumerate(subset_masks):
+        successes = count_successes(search_rows, subset_mask)
+        if successes > best_successes:
+            best_offsets = [offset]
+            best_successes = successes
+        elif successes == best_successes and best_offsets:
+            best_offsets.append(offset)
+    return best_offsets, best_successes
+
+
+@phase("optimal_tree_search")
+def parallel_search(rows, symptoms, depth, workers, progress):
+    best_subset, best_successes = progress.begin(symptoms, depth)
+    index = progress.resume_index
+    subsets = itertools.islice(itertools.combinations(symptoms, depth), index, None)
+    with ProcessPoolExecutor(workers, initializer=init_search_worker, initargs=(rows,)) as executor:
+        # A bounded window of chunks is in flight, so a time budget can stop the search part way.
+        pending = deque()
+        while True:
+            while len(pending) < 2 * workers and (chunk := list(itertools.islice(subsets, SEARCH_CHUNK_SIZE))):
+                pending.append((chunk, executor.submit(search_chunk, [vocabulary.mask(subset) for subset in chunk])))
+            if not pending or progress.expired():
+                executor.shutdown(cancel_futures=True)
+                break
+            # Chunks are merged in enumeration order, so ties still go to the lowest-index subset.
+            chunk, future = pending.popleft()
+            offsets, successes = future.result()
+            progress.stats["evaluated"] += len(chunk)
+            index += len(chunk)
+            improved = False
+            for offset in (offsets if progress.reordered else offsets[:1]):
+                if progress.beats(successes, chunk[offset], best_successes, best_subset):
+                    best_subset, best_successes = chunk[offset], successes
+                    improved = True
+            progress.save(index, best_subset, best_successes)
+            if improved:
+                progress.report(best_subset, best_successes)
+    if not progress.stats["complete"]:
+        progress.save(index, best_subset, best_successes, force=True)
+        progress.stopped_saved = True
+    progress.finish(best_subset, best_successes)
+    return best_subset
+
+
+def rows_digest(rows):
+    # Identifies the training data of a checkpointed search; symptom names keep it independent of bit order.
+    digest = hashlib.sha256()
+    for names, illness, count in sorted((sorted(vocabulary.decode(mask)), illness, count)
+                                        for (mask, illness), count in rows):
+        digest.update(repr((names, illness, count)).encode())
+    return digest.hexdigest()
+
+
+def matrix_rows(matrix):
+    rows = Counter()
+    for mask, illness, count in zip(matrix.masks, matrix.illnesses, matrix.counts):
+        rows[mask, illness] += count
+    return list(rows.items())
+
+
+def symptom_accuracies(records, symptoms):
+    # Training successes of each one-symptom tree, used to try promising subsets first.
+    if isinstance(records, SymptomMatrix):
+        successes = []
+        for symptom in symptoms:
+            yes_rows = records.all_rows & records.column(vocabulary.bit(symptom))
+            successes.append(records.majority(yes_rows) + records.majority(records.all_rows ^ yes_rows))
+        return successes
+    return [count_successes(records, vocabulary.bit(symptom)) for symptom in symptoms]
+
+
+@phase("optimal_tree")
+def optimal_tree(records, symptoms, depth, workers=None, time_budget=None, on_progress=None,
+                 checkpoint=None, checkpoint_interval=60):
     if not (0 <= depth <= len(symptoms)):
         raise ValueError("Depth must be between 0 and len(symptoms).")
     if len(set(symptoms)) != len(symptoms):
         raise ValueError("Symptoms list must not contain duplicates.")
-    if not all(isinstance(record, Record) for record in records):
-        raise TypeError("All elements in records must be of type Record.")
+    if isinstance(records, SymptomMatrix):
+        if records.illnesses is None:
+            raise TypeError("Symptom matrix must be built from records.")
+    else:
+        if not isinstance(records, (list, tuple)):
+            records = deduplicate_records(require_records(records))
+        if not all(isinstance(record, Record) for record in records):
+            raise TypeError("All elements in records must be of type Record.")
     if not all(isinstance(symptom, str) for symptom in symptoms):
         raise TypeError("All elements in symptoms must be strings.")
 
-    best_diagnoser = None
-    best_accuracy = 0
+    if not records:
+        raise ValueError("Records list is empty")
 
-    for subset in itertools.combinations(symptoms, depth):
-        diagnoser = build_tree(records, list(subset))
-        accuracy = diagnoser.calculate_success_rate(records)  # Assumes this function exists
+    rows = records if isinstance(records, SymptomMatrix) else weighted_rows(records)
+    perfect = records.total if isinstance(records, SymptomMatrix) else sum(count for _, count in rows)
+    digest = None
+    if checkpoint is not None:
+        digest = rows_digest(matrix_rows(records) if isinstance(records, SymptomMatrix) else rows)
+    progress = SearchProgress(math.comb(len(symptoms), depth), perfect, time_budget, on_progress,
+                              checkpoint, checkpoint_interval, digest)
+    order = list(symptoms)
+    saved_order = progress.saved_symptoms()
+    if saved_order is not None and sorted(saved_order) == sorted(order):
+        # Resume in the order the checkpointed search used, whatever the caller passes this time.
+        order = saved_order
+    elif time_budget is not None:
+        # Best single symptoms first, so a search cut short has already tried the likeliest subsets.
+        accuracies = dict(zip(symptoms, symptom_accuracies(rows, symptoms)))
+        order.sort(key=lambda symptom: -accuracies[symptom])
+    if order != list(symptoms):
+        progress.rank_ties_in(symptoms)
 
-        if accuracy > best_accuracy:
-            best_diagnoser = diagnoser
-            best_accuracy = accuracy
+    if isinstance(records, SymptomMatrix):
+        best_subset, stats = index_search(records, order, depth, progress=progress)
+    elif workers is not None and workers > 1:
+        best_subset = parallel_search(rows, order, depth, workers, progress)
+        stats = progress.stats
+    else:
+        best_subset, stats = prefix_search(rows, order, depth, progress=progress)
 
-    return best_diagnoser
+    if instrumentation is not None:
+        instrumentation.count("subsets_evaluated", stats["evaluated"])
+        instrumentation.count("subsets_skipped", stats["skipped"])
+    if best_subset is None:
+        return None
+    if order != list(symptoms):
+        best_subset = sorted(best_subset, key=symptoms.index)
+    diagnoser = build_tree(records, list(best_subset))
+    diagnoser.search_stats = stats
+    return diagnoser